@@ -3,20 +3,352 @@
 # It gathers rain data from Wunderground and writes it to .csv files for each station name.
 #
 from bs4 import BeautifulSoup
+try:
+    from lxml import html as lxml_html
+except ImportError:  # the table is then read with BeautifulSoup, which is slower but gives the same result
+    lxml_html = None
+try:
+    import pyarrow
+    import pyarrow.dataset as pyarrow_dataset
+except ImportError:  # only needed for the parquet and feather storage formats
+    pyarrow = pyarrow_dataset = None
 import datetime
 import dateparser
 import re
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
-import simplekml
 import numpy as np
-from openpyxl import load_workbook
+from openpyxl import load_workbook, Workbook
+from openpyxl.cell import Cell, WriteOnlyCell
 from openpyxl.utils.dataframe import dataframe_to_rows
 from openpyxl.formula.translate import Translator
-from selenium import webdriver
+from openpyxl.formula.tokenizer import Tokenizer, Token
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+import multiprocessing
+from urllib.parse import urlsplit
+import sqlite3
+from copy import copy
+import shutil
+import atexit
+import threading
 import time
+import zlib
+import zipfile
+import io
+from xml.sax.saxutils import escape
 import os
 
+# Default number of station-days downloaded at the same time
+MAX_WORKERS = 8
+# Default cap on simultaneous requests sent to any one host
+MAX_REQUESTS_PER_HOST = 4
+# Hosts whose cap is shared by all the station worker processes of a run
+SHARED_HOSTS = ['www.wunderground.com', 'api.weather.com']
+# Days a station-day (or station) confirmed to have no data is skipped before the website is asked again
+EMPTY_TTL_DAYS = 30
+# Seconds to wait for a server before giving up on a request
+REQUEST_TIMEOUT = 30
+# Number of times a failed request is tried again
+MAX_RETRIES = 4
+# Hours without rain that separate two rainfall events
+INTER_EVENT_HOURS = 6
+# Fixed intervals the rain of a station is totalled over, by the name of their <station>_<name>.csv file
+RESAMPLE_INTERVALS = {'5min': '5min', 'hourly': '60min', 'daily': '1D'}
+
+
+class HostLimiter:
+    '''
+    Caps the number of requests in flight to each host. Every fetch thread asks for a slot of the url's host
+    before sending the request, so a large worker pool can never flood a single website.
+    '''
+    def __init__(self, max_per_host=MAX_REQUESTS_PER_HOST):
+        self.max_per_host = max_per_host
+        self._slots = {}
+        self._lock = threading.Lock()
+
+    def slot(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._slots[host]
+
+    def share(self, slots):
+        '''Use the given semaphores (by host) instead of this process's own, so several processes share one cap'''
+        with self._lock:
+            self._slots.update(slots)
+
+
+class HttpClient:
+    '''
+    Shared HTTP layer for every download. It keeps one pooled requests.Session so connections are reused (keep-alive),
+    puts a timeout on every request, caps the requests in flight per host and optionally spaces requests to the same
+    host at least min_interval seconds apart.
+
+    Connection errors, timeouts and 429/5xx responses are retried with exponential backoff and full jitter, honouring
+    Retry-After when the server sends one. The retries are counted per tag (the station name) in retry_counts.
+    '''
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout=REQUEST_TIMEOUT, retries=MAX_RETRIES, backoff=1.0, max_backoff=60.0, min_interval=0.0,
+                 max_per_host=MAX_REQUESTS_PER_HOST):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.min_interval = min_interval
+        self.limiter = HostLimiter(max_per_host)
+        self.retry_counts = Counter()
+        self._next_request = {}
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_per_host)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _wait_turn(self, host):
+        # reserve the next free moment for this host, then sleep until it comes
+        if not self.min_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_request.get(host, now))
+            self._next_request[host] = start + self.min_interval
+        time.sleep(start - now)
+
+    def _delay(self, attempt, page=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = page.headers.get('Retry-After', '') if page is not None else ''
+        if retry_after.isdigit():
+            delay = max(delay, min(self.max_backoff, float(retry_after)))
+        return delay
+
+    def get(self, url, tag=None):
+        '''
+        :param url: url to download
+        :param tag: name the retries are counted under, the host by default
+        :return: the response; after the last retry a 429/5xx response is returned as is, a connection error is raised
+        '''
+        host = urlsplit(url).netloc
+        attempt = 0
+        while True:
+            page = None
+            try:
+                with self.limiter.slot(url):
+                    self._wait_turn(host)
+                    page = self.session.get(url, timeout=self.timeout)
+                if page.status_code not in self.RETRY_STATUS:
+                    return page
+                error = f'status {page.status_code}'
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries:
+                    raise
+                error = e
+            if attempt >= self.retries:
+                return page
+
+            delay = self._delay(attempt, page)
+            attempt += 1
+            with self._lock:
+                self.retry_counts[tag or host] += 1
+            print(f'Retry {attempt} of {url} in {delay:.1f}s ({error})')
+            time.sleep(delay)
+
+    def close(self):
+        self.session.close()
+
+
+# Client shared by all downloads unless a caller asks for its own settings
+http_client = HttpClient()
+
+
+class JobCancelled(Exception):
+    '''Raised inside a running job once the operator has cancelled it'''
+
+
+class JobControl:
+    '''
+    Pause, resume and cancel switches shared between whoever started a job (the GUI) and the threads running it. The
+    job calls checkpoint() between units of work: it blocks there while the job is paused and raises JobCancelled
+    once the job is cancelled.
+    '''
+    def __init__(self, manager=None):
+        # events from a multiprocessing manager let the switches reach jobs running in other processes
+        self._running = manager.Event() if manager is not None else threading.Event()
+        self._running.set()
+        self._cancelled = manager.Event() if manager is not None else threading.Event()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()
+
+    def checkpoint(self):
+        self._running.wait()
+        if self._cancelled.is_set():
+            raise JobCancelled()
+
+    def mirror_to(self, other, done, interval=0.2):
+        '''Copy this control's state onto other every interval seconds until the done event is set'''
+        while not done.wait(interval):
+            if self.cancelled:
+                other.cancel()
+            elif self.paused:
+                other.pause()
+            else:
+                other.resume()
+
+
+# Progress of a station download, sent after every finished day: rows collected so far, throughput in days per second
+# and the estimated seconds left for the station
+ProgressEvent = namedtuple('ProgressEvent', ['station', 'day', 'days_done', 'days_total', 'rows', 'throughput', 'eta'])
+
+
+class PageCache:
+    '''
+    On-disk cache of downloaded dashboard pages, stored zlib-compressed in an SQLite file and keyed by (station, date).
+    Pages that span several days are kept in their own table, keyed by (station, start date, end date).
+
+    A page is reused only if it was fetched after its day had ended everywhere (UTC-12), so completed past days never
+    expire while "today", or a day that was still running when it was fetched, is always downloaded again.
+
+    It is also the negative cache: completed station-days confirmed to have no data, and station date ranges with no
+    data at all, are skipped without a request until they are empty_ttl_days old.
+    '''
+    def __init__(self, folder, empty_ttl_days=EMPTY_TTL_DAYS):
+        os.makedirs(folder, exist_ok=True)
+        self.empty_ttl = datetime.timedelta(days=empty_ttl_days)
+        self.path = os.path.join(folder, 'pages.sqlite')
+        self._lock = threading.Lock()
+        # several station processes may share the file, so wait for a busy database rather than fail
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages '
+                         '(station TEXT, day TEXT, fetched TEXT, content BLOB, PRIMARY KEY (station, day))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS range_pages '
+                         '(station TEXT, day TEXT, end_day TEXT, fetched TEXT, content BLOB, '
+                         'PRIMARY KEY (station, day, end_day))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS empty_days (station TEXT, day TEXT, checked TEXT, '
+                         'PRIMARY KEY (station, day))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS empty_stations (station TEXT, day TEXT, end_day TEXT, checked TEXT)')
+        self._db.commit()
+
+    @staticmethod
+    def is_complete(date, fetched):
+        # the last place to finish a day is UTC-12, 12 hours after midnight UTC
+        day_end = datetime.datetime.strptime(date, '%Y-%m-%d') + datetime.timedelta(days=1, hours=12)
+        return datetime.datetime.fromisoformat(fetched) >= day_end
+
+    def get(self, station, date, end_date=None):
+        with self._lock:
+            if end_date in (None, date):
+                row = self._db.execute('SELECT fetched, content FROM pages WHERE station=? AND day=?',
+                                       (station.upper(), date)).fetchone()
+            else:
+                row = self._db.execute('SELECT fetched, content FROM range_pages WHERE station=? AND day=? AND end_day=?',
+                                       (station.upper(), date, end_date)).fetchone()
+        if row is None or not self.is_complete(end_date or date, row[0]):
+            return None
+        return zlib.decompress(row[1])
+
+    def put(self, station, date, content, end_date=None):
+        fetched = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        with self._lock:
+            if end_date in (None, date):
+                self._db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                                 (station.upper(), date, fetched, zlib.compress(content)))
+            else:
+                self._db.execute('INSERT OR REPLACE INTO range_pages VALUES (?, ?, ?, ?, ?)',
+                                 (station.upper(), date, end_date, fetched, zlib.compress(content)))
+            self._db.commit()
+
+    def _fresh_since(self):
+        return (datetime.datetime.utcnow() - self.empty_ttl).isoformat(timespec='seconds')
+
+    def empty_days(self, station, date, end_date):
+        '''The days from date to end_date ("%Y-%m-%d") recently confirmed to have no data'''
+        with self._lock:
+            rows = self._db.execute('SELECT day FROM empty_days WHERE station=? AND day BETWEEN ? AND ? AND checked>?',
+                                    (station.upper(), date, end_date, self._fresh_since())).fetchall()
+        return {day for day, in rows}
+
+    def mark_empty_day(self, station, date):
+        '''Record a day without data, once it has ended; its page is dropped so that it expires with the entry'''
+        checked = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        if not self.is_complete(date, checked):
+            return
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO empty_days VALUES (?, ?, ?)', (station.upper(), date, checked))
+            self._db.execute('DELETE FROM pages WHERE station=? AND day=?', (station.upper(), date))
+            self._db.commit()
+
+    def station_is_empty(self, station, date, end_date):
+        '''Whether a recent run found no data at all for the station over a range covering date to end_date'''
+        with self._lock:
+            row = self._db.execute('SELECT 1 FROM empty_stations WHERE station=? AND day<=? AND end_day>=? AND checked>?',
+                                   (station.upper(), date, end_date, self._fresh_since())).fetchone()
+        return row is not None
+
+    def mark_empty_station(self, station, date, end_date):
+        checked = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        if not self.is_complete(end_date, checked):
+            return
+        with self._lock:
+            self._db.execute('INSERT INTO empty_stations VALUES (?, ?, ?, ?)', (station.upper(), date, end_date, checked))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Function to build the dashboard url of one station from date to end_date (the same day by default)
+def dashboard_url(station, date, end_date=None):
+    return 'https://www.wunderground.com/dashboard/pws/' + station.upper() + '/table/' + date + '/' + (end_date or date) + '/daily'
+
+
+# Response statuses that fail the station instead of counting as a day without data: a 429/5xx left after the last
+# retry and a 403 bot block. Any other status, such as the 404/410 of a retired or mistyped station, is a day without data
+FAIL_STATUS = HttpClient.RETRY_STATUS + (403,)
+
+
+# Function to get the dashboard page of one station and day (or range of days), from the cache when it holds a completed copy
+def fetch_page(station, date, client=None, cache=None, end_date=None):
+    url = dashboard_url(station, date, end_date)
+    if cache is not None:
+        content = cache.get(station, date, end_date)
+        if content is not None:
+            print('loading cached page', url)
+            return content
+
+    print('fetching page', url)
+    page = (client or http_client).get(url, tag=station.upper())
+    if page.status_code in FAIL_STATUS:
+        # the station fails and its day is fetched again on the next run
+        raise requests.HTTPError(f'Status {page.status_code} for {url}', response=page)
+    # only a page with the history table is kept: a consent page, bot check or error shell also comes back as 200, and
+    # a cached copy of it would stand in for the day on every later run (empty days are kept by mark_empty_day instead)
+    if cache is not None and history_table_html(page.content) is not None:
+        cache.put(station, date, page.content, end_date)
+    return page.content
+
+
 # Function to convert string to datetime format
 def convert(date_time_in):
         datetime_str = dateparser.parse(date_time_in)
@@ -29,18 +361,281 @@ def daterange(start_date, end_date):
         yield start_date + datetime.timedelta(n)
 
 
+# Function to split a date range into windows of up to range_days days
+def date_windows(start_date, end_date, range_days):
+    '''
+    The windows are aligned on fixed blocks of range_days days (counted from the first day of the calendar), so the
+    same days always fall into the same window and range pages stay reusable from the cache across runs.
+    '''
+    window = []
+    for single_date in daterange(start_date, end_date):
+        if window and single_date.toordinal() // range_days != window[0].toordinal() // range_days:
+            yield window
+            window = []
+        window.append(single_date)
+    if window:
+        yield window
+
+
+# Function to read the hidden longitude and latitude of a parsed dashboard page, None when the page has none
+def find_coordinates(soup):
+    try:
+        test = soup.find_all("script", attrs={'id': 'app-root-state'})
+        test_content = test[0].contents[0]
+
+        pattern_lon = re.compile(r"lon&q;:(.*?),&q;")
+        pattern_lat = re.compile(r"lat&q;:(.*?),&q;")
+        lon = (pattern_lon.findall(test_content)[0])
+        lat = (pattern_lat.findall(test_content)[0])
+    except IndexError:
+        return None
+    return lon, lat
+
+
+# Function to read the hidden longitude and latitude straight from the page's app-root-state script, without parsing
+# the rest of the page
+def page_coordinates(content):
+    match = re.search(rb'<script[^>]*\bid="app-root-state"[^>]*>(.*?)</script>', content, re.DOTALL)
+    if match is None:
+        return None
+    test_content = match.group(1).decode('utf-8', errors='replace')
+    lon = re.findall(r"lon&q;:(.*?),&q;", test_content)
+    lat = re.findall(r"lat&q;:(.*?),&q;", test_content)
+    if not lon or not lat:
+        return None
+    return lon[0], lat[0]
+
+
+# Pattern of a latitude or longitude key and its number in JSON, plain or escaped with &q; as the dashboard does
+COORDINATE_PATTERN = r'(?:&q;|")(lat|latitude|lon|lng|longitude)(?:&q;|")\s*:\s*(?:&q;|")?(-?\d{1,3}(?:\.\d+)?)'
+
+
+# Function to look for coordinates in the other data embedded in a page: JSON in any script (escaped or not) and the
+# geo meta tags
+def embedded_coordinates(content, station=None):
+    '''
+    A page also carries the locations of nearby stations and of the visitor, so latitude and longitude are only taken
+    as a pair from one JSON object (with no object nested inside it). The object naming the station wins; without one,
+    the pair is only trusted when every object on the page agrees on it.
+
+    :return: (lon, lat) as text, or None
+    '''
+    text = content.decode('utf-8', errors='replace') if isinstance(content, bytes) else content
+    pairs = []
+    for json_object in re.findall(r'\{[^{}]*\}', text):
+        values = {}
+        for key, value in re.findall(COORDINATE_PATTERN, json_object):
+            values.setdefault(key[:3].replace('lng', 'lon'), value)
+        if 'lat' in values and 'lon' in values:
+            pair = values['lon'], values['lat']
+            if station and re.search(r'(?:&q;|")' + re.escape(station) + r'(?:&q;|")', json_object, re.IGNORECASE):
+                return pair
+            pairs.append(pair)
+    if pairs and len(set(pairs)) == 1:
+        return pairs[0]
+    if pairs:
+        return None
+    meta = re.search(r'<meta[^>]*name="(?:geo\.position|ICBM)"[^>]*content="\s*(-?[\d.]+)\s*[;,]\s*(-?[\d.]+)', text)
+    if meta is not None:
+        return meta.group(2), meta.group(1)
+    return None
+
+
+# Function to ask the weather.com PWS API for a station's coordinates, with the api key the dashboard page embeds
+def api_coordinates(station, date, content, client=None):
+    text = content.decode('utf-8', errors='replace') if isinstance(content, bytes) else content
+    key = re.search(r'(?:&q;|")apiKey(?:&q;|")\s*:\s*(?:&q;|")(\w+)(?:&q;|")', text)
+    if key is None:
+        return None
+    url = (f'https://api.weather.com/v2/pws/history/all?stationId={station.upper()}&format=json&units=e'
+           f'&date={date.replace("-", "")}&apiKey={key.group(1)}')
+    try:
+        response = (client or http_client).get(url, tag=station.upper())
+        observations = response.json().get('observations') if response.status_code == 200 else None
+    except (requests.RequestException, ValueError):
+        return None
+    for observation in observations or []:
+        if observation.get('lat') is not None and observation.get('lon') is not None:
+            return str(observation['lon']), str(observation['lat'])
+    return None
+
+
+# Function to read the 'Latitude / Longitude' line of the station info overlay, e.g. '37.583 °N, 122.350 °W'
+def overlay_coordinates(line):
+    values = re.findall(r'(\d+(?:\.\d+)?)\s*°?\s*([NSEW])', line)
+    if len(values) < 2:
+        return None
+    lat, lon = [-float(number) if hemisphere in 'SW' else float(number) for number, hemisphere in values[:2]]
+    return lon, lat
+
+
+class SharedBrowser:
+    '''
+    One headless Chrome for the whole run, for the stations whose coordinates are nowhere in the page or the API. It is
+    started the first time a station needs it, shared by all of them (one at a time), and closed when the program
+    exits. selenium is only imported then. chromedriver is found by selenium, or taken from the CHROMEDRIVER variable.
+    '''
+    INFO_BUTTON = '//*[@id="inner-content"]/div[1]/app-dashboard-header/div[2]/div/div[2]/div/lib-pws-info-icon/mat-icon'
+
+    def __init__(self, wait=10):
+        self.wait = wait
+        self._driver = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless=new')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--no-sandbox')
+        service = Service(os.environ['CHROMEDRIVER']) if os.environ.get('CHROMEDRIVER') else Service()
+        driver = webdriver.Chrome(service=service, options=options)
+        atexit.register(self.close)
+        return driver
+
+    def coordinates(self, station, date):
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions
+        from selenium.webdriver.support.ui import WebDriverWait
+        with self._lock:
+            if self._driver is None:
+                self._driver = self._start()
+            driver = self._driver
+            driver.get(dashboard_url(station, date))
+            # the rendered page often carries the data the downloaded one did not
+            coords = embedded_coordinates(driver.page_source, station)
+            if coords is not None:
+                return coords
+            # otherwise open the station info overlay, as a user would
+            WebDriverWait(driver, self.wait).until(
+                expected_conditions.element_to_be_clickable((By.XPATH, self.INFO_BUTTON))).click()
+            overlay = WebDriverWait(driver, self.wait).until(
+                expected_conditions.visibility_of_element_located((By.CLASS_NAME, 'cdk-overlay-container')))
+            for line in overlay.text.split('\n'):
+                if 'Latitude / Longitude' in line:
+                    return overlay_coordinates(line)
+            return None
+
+    def close(self):
+        with self._lock:
+            if self._driver is not None:
+                self._driver.quit()
+                self._driver = None
+
+
+# The browser of the coordinate fallback, shared by all the stations of a process
+shared_browser = SharedBrowser()
+
+
+# Function to cut the desktop history table out of a dashboard page, None when the page has none
+def history_table_html(content):
+    for match in re.finditer(rb'<table\b[^>]*?\bclass="([^"]*)"', content):
+        classes = match.group(1).split()
+        if b'desktop-table' in classes and b'history-table' in classes:
+            end = content.find(b'</table>', match.end())
+            if end == -1:
+                return None
+            return content[match.start():end + len(b'</table>')].decode('utf-8', errors='replace')
+    return None
+
+
+# Names of the history table columns AquaTrack keeps, in the order of the datetime, prate and paccum columns
+RAIN_COLUMNS = ['Time', 'Precip. Rate.', 'Precip. Accum.']
+# Pattern of the number in a rain cell such as "0.01\xa0in"
+NUMBER_PATTERN = r'(\d*\.\d+|\d+)'
+
+
+# Function to read the Time, Precip. Rate. and Precip. Accum. cells of a dashboard page's history table
+def rain_cells(content):
+    '''
+    The page is not parsed as a whole: the history table is cut out of the html first and only that piece is read, with
+    lxml when it is installed, and only the three rain columns are kept as plain lists of text.
+
+    :param content: html of a dashboard page
+    :return: [times, rates, accums], or None when the page has no history table with these columns
+    '''
+    table_html = history_table_html(content)
+    if table_html is None:
+        return None
+    if lxml_html is None:
+        df_data = raw_table_from_soup(BeautifulSoup(table_html, 'html.parser'))
+        if not set(RAIN_COLUMNS).issubset(df_data.columns):
+            return None
+        return [df_data[name].tolist() for name in RAIN_COLUMNS]
+
+    table = lxml_html.fragment_fromstring(table_html)
+    head_names = [head.text_content() for head in table.xpath('.//thead//tr//th')]
+    if not set(RAIN_COLUMNS).issubset(head_names):
+        return None
+    positions = [head_names.index(name) for name in RAIN_COLUMNS]
+
+    columns = [[], [], []]
+    for row in table.xpath('.//tbody//tr'):
+        all_cells = row.xpath('.//td')
+        for column, position in zip(columns, positions):
+            if position < len(all_cells):
+                column.append(all_cells[position].text_content().replace(u'\xa0°', u' ').strip())
+            else:
+                column.append(None)
+    return columns
+
+
+# Function to convert rain cells such as "0.01\xa0in" or "--" into a float32 array, NaN where there is no number
+def cells_to_float32(cells):
+    '''
+    A station run repeats the same few cell texts over and over, so each distinct text is parsed once and the numbers
+    are spread back over all rows with one array lookup.
+    '''
+    codes, uniques = pd.factorize(np.asarray(cells, dtype=object))
+    numbers = pd.Series(uniques, dtype=object).str.extract(NUMBER_PATTERN, expand=False).astype(np.float32).to_numpy()
+    # missing cells get code -1, which picks the NaN appended at the end
+    return np.append(numbers, np.float32(np.nan))[codes]
+
+
+# Function to build the datetime, prate and paccum table of a batch of rows in one vectorized step
+def rain_frame(datetimes, rates, accums):
+    return pd.DataFrame({'datetime': datetimes,
+                         'prate': cells_to_float32(rates),
+                         'paccum': cells_to_float32(accums)})
+
+
+# Function to turn the datetime text of a rain table into datetimes, as fill_excel reads them from the csv
+def parse_datetimes(df):
+    return df.assign(datetime=pd.to_datetime(df['datetime'], format='%Y-%m-%d %I:%M %p'))
+
+
+# Function to parse a dashboard page once for both its rain rows and its coordinates
+def parse_day_page(content, date):
+    '''
+    :param content: html of the daily dashboard page
+    :param date: the page's date, "%Y-%m-%d"
+    :return: the day's rows as [datetimes, rates, accums] text lists, or None when the page has no history table, and
+    (lon, lat), or None when the page has no coordinates
+    '''
+    cells = rain_cells(content)
+    if cells is not None:
+        times, rates, accums = cells
+        cells = [[date + ' ' + time_of_day for time_of_day in times], rates, accums]
+    return cells, page_coordinates(content)
+
+
 # Function to collect data for one day
-def fetch_one_day(station, date, paccumchoice, savefolder):
+def fetch_one_day(station, date, paccumchoice, savefolder, client=None, cache=None):
     # # debug line
     # station = 'Kcaburli4'
     # date = endDate.strftime("%Y-%m-%d")
     paccumchoice = 'yes'
 
-    url = 'https://www.wunderground.com/dashboard/pws/' + station.upper() + '/table/' + date + '/' + date + '/daily'
-    print('fetching page', url)
-    page = requests.get(url)
+    content = fetch_page(station, date, client, cache)
+    day_rows, _ = parse_day_page(content, date)
+    if day_rows is None:
+        raise KeyError(f'No rain table for Station {station} on {date}')
+    return rain_frame(*day_rows)
 
-    soup = BeautifulSoup(page.content, 'html.parser')
+
+# Function to read the history table of a parsed dashboard page as text, one column per table head
+def raw_table_from_soup(soup):
     # rows = soup.select('.history-table tr')
 
     table_heads = soup.select('table.desktop-table.history-table thead tr th')
@@ -63,121 +658,1394 @@ def fetch_one_day(station, date, paccumchoice, savefolder):
 
     df_data = pd.DataFrame(data_all_rows)
     df_data.columns = head_names
+    return df_data
+
 
-    df_data_export = df_data.copy()
-    df_data_export['Precip. Accum.'] = df_data_export['Precip. Accum.'].str.extract('(\d*\.\d+|\d+)',expand=False).astype(float)
-    df_data_export['Precip. Rate.'] = df_data_export['Precip. Rate.'].str.extract('(\d*\.\d+|\d+)',expand=False).astype(float)
-    df_data_export['Time'] = date + ' '+ df_data_export['Time']
-    df_data_export = df_data_export[['Time', 'Precip. Rate.', 'Precip. Accum.']].replace('--', np.NAN)
-    df_data_export = df_data_export.rename(columns = {'Time':"datetime", "Precip. Rate.":"prate", 'Precip. Accum.':"paccum"})
-    df_data_export.reset_index(drop=True, inplace=True)
-    # df_data_export.to_csv(savefolder + '/'+station + '.csv', index=False)
+class JobManifest:
+    '''
+    Checkpoints of a station list run, kept in an SQLite file in the save folder so that a crashed or cancelled run can
+    be resumed. For each station it records the date range, the last day whose rows are safely in the part output of
+    every storage format (with the size of each part output at that point), the coordinates, and whether the station's
+    data and the processed Excel file are finished. A station whose date range changed starts over. With the Excel file
+    go the settings it was written with (see excel_settings) and the counts of its rain summary: a station asked for
+    with other settings has its Excel file written again.
+    '''
+    COLUMNS = ['station', 'start_day', 'end_day', 'last_day', 'rows', 'lon', 'lat', 'data_done', 'excel_done',
+               'excel_mode', 'rain_summary', 'inter_event_hours', 'template', 'template_mtime', 'events', 'flagged']
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.execute('CREATE TABLE IF NOT EXISTS stations (station TEXT PRIMARY KEY, start_day TEXT, end_day TEXT, '
+                         'last_day TEXT, rows INTEGER, lon TEXT, lat TEXT, data_done INTEGER, excel_done INTEGER, '
+                         'excel_mode TEXT, rain_summary INTEGER, inter_event_hours REAL, template TEXT, '
+                         'template_mtime REAL, events INTEGER, flagged INTEGER)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS checkpoints (station TEXT, format TEXT, size INTEGER, '
+                         'PRIMARY KEY (station, format))')
+        self._db.commit()
+
+    def _execute(self, sql, parameters):
+        with self._lock:
+            self._db.execute(sql, parameters)
+            self._db.commit()
+
+    def station(self, station, start_date, end_date, excel=None):
+        '''
+        The recorded state of a station, reset first when it was recorded for another date range. Its 'sizes' are the
+        part output sizes of the last checkpoint, by storage format. With excel, the settings of the Excel file asked
+        for (see excel_settings), an Excel file written with other settings is no longer counted as done.
+        '''
+        start, end = start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+        with self._lock:
+            row = self._db.execute(f'SELECT {", ".join(self.COLUMNS)} FROM stations WHERE station=?',
+                                   (station,)).fetchone()
+            sizes = dict(self._db.execute('SELECT format, size FROM checkpoints WHERE station=?', (station,)))
+        if row is None or row[1:3] != (start, end):
+            with self._lock:
+                self._db.execute('INSERT OR REPLACE INTO stations (station, start_day, end_day, rows, data_done, '
+                                 'excel_done) VALUES (?, ?, ?, 0, 0, 0)', (station, start, end))
+                self._db.execute('DELETE FROM checkpoints WHERE station=?', (station,))
+                self._db.commit()
+            row, sizes = (station, start, end, None, 0, None, None, 0, 0) + (None,) * (len(self.COLUMNS) - 9), {}
+        state = dict(zip(self.COLUMNS, row), sizes=sizes)
+        if excel is not None and state['excel_done'] and \
+                any(state[column] != setting for column, setting in excel.items()):
+            self._execute('UPDATE stations SET excel_done=0 WHERE station=?', (station,))
+            state['excel_done'] = 0
+        return state
+
+    def record_days(self, station, last_day, sizes, rows):
+        with self._lock:
+            self._db.execute('UPDATE stations SET last_day=?, rows=? WHERE station=?',
+                             (last_day.strftime("%Y-%m-%d"), rows, station))
+            self._db.executemany('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)',
+                                 [(station, file_format, size) for file_format, size in sizes.items()])
+            self._db.commit()
+
+    def record_data(self, station, rows):
+        self._execute('UPDATE stations SET data_done=1, rows=? WHERE station=?', (rows, station))
+
+    def record_coordinates(self, station, lon, lat):
+        self._execute('UPDATE stations SET lon=?, lat=? WHERE station=?', (str(lon), str(lat), station))
+
+    def record_excel(self, station, excel=None, events=0, flagged=0):
+        excel = excel or {}
+        self._execute(f'UPDATE stations SET excel_done=1, events=?, flagged=?'
+                      f'{"".join(f", {column}=?" for column in excel)} WHERE station=?',
+                      (events, flagged, *excel.values(), station))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class StationCsvWriter:
+    '''
+    Writes a station csv a batch of days at a time. Each day's rows are appended once to <station>.csv.part, which
+    replaces <station>.csv when the writer is finalized, so the cost of writing grows linearly with the number of days.
+    With resume_size, an earlier part file is cut back to that size (its last checkpoint) and appended to. With
+    keep_before, the rows of the existing <station>.csv dated before that day are carried over first, so the new rows
+    replace only the days from keep_before on.
+    '''
+    # appended batches keep the datetime text of the pages
+    typed = False
+
+    def __init__(self, path, resume_size=0, keep_before=None):
+        self.path = path
+        self.part_path = path + '.part'
+        self.rows = 0
+        self.written = resume_size > 0
+        if resume_size:
+            os.truncate(self.part_path, resume_size)
+            self._file = open(self.part_path, 'a', newline='')
+        else:
+            self._file = open(self.part_path, 'w', newline='')
+            if keep_before is not None and os.path.isfile(path):
+                self._keep_rows(keep_before.strftime("%Y-%m-%d"))
+
+    def _keep_rows(self, first_day):
+        # every row starts with its '%Y-%m-%d' date and the rows are in time order, so the text alone finds the cut
+        with open(self.path, newline='') as existing:
+            header = existing.readline()
+            for line in existing:
+                if line.startswith('datetime'):
+                    continue
+                if line[:10] >= first_day:
+                    break
+                if not self.written:
+                    self._file.write(header)
+                    self.written = True
+                self._file.write(line)
+                self.rows += 1
+
+    def checkpoint(self):
+        '''Push the rows written so far to disk and return the size of the part file'''
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return os.path.getsize(self.part_path)
+
+    def append(self, df):
+        df.to_csv(self._file, index=False, header=not self.written)
+        self.written = True
+        self.rows += len(df)
+
+    def finalize(self):
+        '''
+        Close the part file and move it into place. Returns False when no day had any data, in which case no csv is
+        written.
+        '''
+        self._file.close()
+        if not self.written:
+            os.remove(self.part_path)
+            return False
+        os.replace(self.part_path, self.path)
+        return True
+
+    def abort(self):
+        # a run that stops half way leaves <station>.csv as it was, the rows written so far stay in the part file
+        self._file.close()
+
+
+# Storage formats of the station data, csv files or a dataset (directory) of pyarrow files in the save folder
+STORAGE_FORMATS = ['csv', 'parquet', 'feather']
+STORE_FOLDERS = {'parquet': 'rain.parquet', 'feather': 'rain.feather'}
+
+
+class StationStoreWriter:
+    '''
+    Writes a station's rows into the partitioned dataset <savefolder>/rain.parquet (or rain.feather), one directory per
+    station and month (station=<name>/month=<YYYY-MM>), keeping the typed datetime and float32 columns. As with
+    StationCsvWriter, each batch goes to a staging directory (_staging, which readers skip) that replaces the station's
+    partition when the writer is finalized. The part output is counted in batch files: resume_size keeps that many.
+    '''
+    # appended batches have parsed datetimes
+    typed = True
+
+    def __init__(self, savefolder, station, file_format='parquet', resume_size=0, keep_before=None):
+        if pyarrow_dataset is None:
+            raise ImportError(f'The {file_format} storage format needs pyarrow (pip install pyarrow)')
+        self.savefolder = savefolder
+        self.station = station
+        self.file_format = file_format
+        self.path = os.path.join(savefolder, STORE_FOLDERS[file_format], f'station={station}')
+        self.part_path = station_part_path(savefolder, station, file_format)
+        self.rows = 0
+        if resume_size:
+            for name, index in self.batch_files(self.part_path):
+                if index >= resume_size:
+                    os.remove(name)
+            self.batches = resume_size
+        else:
+            shutil.rmtree(self.part_path, ignore_errors=True)
+            self.batches = 0
+            if keep_before is not None and os.path.isdir(self.path):
+                kept = read_station_store(savefolder, station, end=keep_before, file_format=file_format)
+                if len(kept):
+                    self.append(kept)
+                    self.rows = len(kept)
+        self.written = self.batches > 0
+
+    @staticmethod
+    def batch_files(part_path):
+        '''The batch files of a part output with their batch numbers'''
+        files = []
+        for folder, _, names in os.walk(part_path):
+            for name in names:
+                if name.startswith('batch'):
+                    files.append((os.path.join(folder, name), int(name[5:].split('-')[0])))
+        return files
+
+    def append(self, df):
+        table = df.assign(month=df['datetime'].dt.strftime('%Y-%m'))
+        pyarrow_dataset.write_dataset(pyarrow.Table.from_pandas(table, preserve_index=False), self.part_path,
+                                      format=self.file_format, partitioning=['month'], partitioning_flavor='hive',
+                                      basename_template=f'batch{self.batches:06d}-{{i}}.{self.file_format}',
+                                      existing_data_behavior='overwrite_or_ignore')
+        self.batches += 1
+        self.written = True
+        self.rows += len(df)
+
+    def checkpoint(self):
+        return self.batches
+
+    def finalize(self):
+        if not self.written:
+            shutil.rmtree(self.part_path, ignore_errors=True)
+            return False
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(self.part_path, self.path)
+        return True
+
+    def abort(self):
+        # the batches written so far stay in the staging directory
+        pass
+
+
+# Function to give the part output (staging) path of a station in a storage format
+def station_part_path(savefolder, station, file_format):
+    if file_format == 'csv':
+        return savefolder + '/' + station + '.csv.part'
+    return os.path.join(savefolder, STORE_FOLDERS[file_format], '_staging', f'station={station}')
+
+
+# Function to open the writer of a station in one storage format
+def open_station_writer(file_format, savefolder, station, resume_size=0, keep_before=None):
+    if file_format == 'csv':
+        return StationCsvWriter(savefolder + '/' + station + '.csv', resume_size, keep_before)
+    return StationStoreWriter(savefolder, station, file_format, resume_size, keep_before)
+
+
+# Function to measure what a station's part output in a storage format holds, 0 when there is none
+def part_output_size(file_format, savefolder, station):
+    part_path = station_part_path(savefolder, station, file_format)
+    if file_format == 'csv':
+        return os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+    return len({index for _, index in StationStoreWriter.batch_files(part_path)})
+
+
+# Function to tell whether a station's finished output exists in a storage format
+def station_output_exists(file_format, savefolder, station):
+    if file_format == 'csv':
+        return os.path.isfile(savefolder + '/' + station + '.csv')
+    return os.path.isdir(os.path.join(savefolder, STORE_FOLDERS[file_format], f'station={station}'))
+
+
+# Function to read a station's rows back from a parquet or feather dataset, between start (included) and end (excluded)
+def read_station_store(savefolder, station, start=None, end=None, file_format='parquet'):
+    '''
+    The station and month partitions and the datetime column filter the dataset as it is scanned, so only the files of
+    the months in the range are opened, and only their matching row groups read.
 
-    return df_data_export
+    :return: datetime, prate and paccum table in time order, datetimes parsed and rain values float32
+    '''
+    dataset = pyarrow_dataset.dataset(os.path.join(savefolder, STORE_FOLDERS[file_format]), format=file_format,
+                                      partitioning='hive')
+    condition = pyarrow_dataset.field('station') == station
+    if start is not None:
+        condition &= (pyarrow_dataset.field('month') >= start.strftime('%Y-%m')) & \
+                     (pyarrow_dataset.field('datetime') >= pd.Timestamp(start))
+    if end is not None:
+        condition &= (pyarrow_dataset.field('month') <= end.strftime('%Y-%m')) & \
+                     (pyarrow_dataset.field('datetime') < pd.Timestamp(end))
+    table = dataset.to_table(columns=['datetime', 'prate', 'paccum'], filter=condition).to_pandas()
+    return table.sort_values('datetime', kind='stable', ignore_index=True)
+
+
+# Function to find the day of the last row of a station csv, None when there is no csv or it has no rows
+def last_csv_day(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as file:
+        # only the end of the file is read, however many years it holds
+        file.seek(0, os.SEEK_END)
+        file.seek(max(0, file.tell() - 4096))
+        lines = file.read().decode(errors='ignore').splitlines()
+    for line in reversed(lines[1:] if len(lines) > 1 else lines):
+        if line.strip() and not line.startswith('datetime'):
+            return datetime.datetime.strptime(line[:10], "%Y-%m-%d")
+    return None
+
+
+# Function to give the settings a station's Excel file is written with, as recorded in the JobManifest
+def excel_settings(exceltemp, excel_mode, rain_summary, inter_event_hours):
+    '''
+    :return: dict of the excel_mode, rain_summary and inter_event_hours, and of the template's absolute path and
+    modification time, so that a new or edited template counts as another setting
+    '''
+    return {'excel_mode': excel_mode, 'rain_summary': int(bool(rain_summary)),
+            'inter_event_hours': float(inter_event_hours), 'template': os.path.abspath(exceltemp),
+            'template_mtime': os.path.getmtime(exceltemp)}
 
 
+# Function to find the day of a station's last row in a storage format, None when the station has no data there
+def last_saved_day(file_format, savefolder, station):
+    if file_format == 'csv':
+        return last_csv_day(savefolder + '/' + station + '.csv')
+    if not station_output_exists(file_format, savefolder, station):
+        return None
+    # the last month partition holds the last row
+    months = sorted(os.listdir(os.path.join(savefolder, STORE_FOLDERS[file_format], f'station={station}')))
+    last_month = datetime.datetime.strptime(months[-1].split('=')[1], '%Y-%m')
+    last = read_station_store(savefolder, station, start=last_month, file_format=file_format)['datetime'].max()
+    return None if pd.isna(last) else datetime.datetime.combine(last.date(), datetime.time())
+
+
+# Minutes the clock of a station goes back when daylight saving time ends
+DST_SHIFT_MINUTES = 60
+
+
+# Function to give every row of a multi-day table its date, None when the rows cannot be matched to the window's days
+def assign_range_dates(times, window):
+    '''
+    A multi-day table lists its rows in time order without dates, so a new day starts wherever the time of day goes
+    back by more than DST_SHIFT_MINUTES; the smaller step back of the repeated hour on the day daylight saving time
+    ends stays within its day. The split is only trusted when it yields exactly one run of rows per day of the window; a day with no
+    rows, or a page that ignored the end date, would shift the dates and sends the window back to per-day requests.
+    '''
+    clock = pd.to_datetime(times, format='%I:%M %p', errors='coerce')
+    if clock.isna().any():
+        return None
+    minutes = clock.dt.hour * 60 + clock.dt.minute
+    day_index = (minutes.diff() < -DST_SHIFT_MINUTES).cumsum()
+    if len(day_index) == 0 or day_index.iloc[-1] != len(window) - 1:
+        return None
+    day_names = np.array([single_date.strftime("%Y-%m-%d") for single_date in window])
+    return pd.Series(day_names[day_index.to_numpy()], index=times.index)
+
+
+# Function to parse a page covering the days of window into the rows of each day, None when it cannot be split
+def parse_range_page(content, window):
+    cells = rain_cells(content)
+    if cells is None:
+        return None
+    times, rates, accums = cells
+    dates = assign_range_dates(pd.Series(times, dtype=object), window)
+    if dates is None:
+        return None
+    datetimes = (dates + ' ' + pd.Series(times, dtype=object)).tolist()
+    # the rows are in date order, so each day is one slice between the places where the date changes
+    bounds = np.flatnonzero(dates.to_numpy()[1:] != dates.to_numpy()[:-1]) + 1
+    coords = page_coordinates(content)
+    days = []
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(times)]):
+        days.append(([datetimes[start:end], rates[start:end], accums[start:end]], coords if not days else None))
+    return days
+
+
+# Function to fetch a window of days with one request, falling back to one request per day when the page will not split
+def fetch_window(station, window, paccumchoice, savefolder, client=None, cache=None, control=None, skip=frozenset()):
+    '''
+    :param skip: days ("%Y-%m-%d") known to have no data, given (None, None) without a request
+    '''
+    if control is not None:
+        control.checkpoint()
+    # a known empty day would stop the range page from splitting into days anyway
+    if len(window) > 1 and not skip.intersection(single_date.strftime("%Y-%m-%d") for single_date in window):
+        start, end = window[0].strftime("%Y-%m-%d"), window[-1].strftime("%Y-%m-%d")
+        days = parse_range_page(fetch_page(station, start, client, cache, end), window)
+        if days is not None:
+            return days
+        print(f'The page for Station {station} from {start} to {end} could not be split into days, fetching them one by one')
+    days = []
+    for single_date in window:
+        if single_date.strftime("%Y-%m-%d") in skip:
+            days.append((None, None))
+            continue
+        if control is not None:
+            control.checkpoint()
+        days.append(fetch_day_or_none(station, single_date, paccumchoice, savefolder, client, cache))
+    return days
+
+
+# Function to fetch and parse one day, returning the day's rows (None if the day has no data) and the coordinates
+def fetch_day_or_none(station, single_date, paccumchoice, savefolder, client=None, cache=None):
+    date = single_date.strftime("%Y-%m-%d")
+    day_rows, coords = parse_day_page(fetch_page(station, date, client, cache), date)
+    if day_rows is None:
+        print(f'Oops, The data for Station {station} is not available at {single_date}, please check the website and consider changing the '
+              f'date range or just skipping this station.')
+        # only a real dashboard page (it has the station's coordinates) confirms that the day is empty
+        if cache is not None and coords is not None:
+            cache.mark_empty_day(station, date)
+    return day_rows, coords
+
 
 # Function to Collect Rain Data for one station, every day from start date to end date
-def collect_all_days(station, start_date, end_date, paccumchoice, savefolder):
+def collect_all_days(station, start_date, end_date, paccumchoice, savefolder, max_workers=MAX_WORKERS, max_per_host=None,
+                     cache=None, coordinates=None, range_days=1, client=None, batch_days=31, frames=None,
+                     progress=None, control=None, manifest=None, keep_earlier=False, formats=('csv',), skipped=None):
     '''
     This function obtains all RG data from the website and return a list of rain gauge names that are not available
-    on the webiste
+    on the webiste. The days are downloaded by a pool of threads, many days in flight at once, and the results are
+    handled in date order. The scraped text of batch_days days at a time is converted to numbers in one vectorized step
+    and appended to the csv.
 
     :param station: station name from the list
     :param start_date: start date from the list
     :param end_date: end date from the list
     :param paccumchoice: may need to used in the future
     :param savefolder: export csv files to
+    :param max_workers: number of days downloaded at the same time
+    :param max_per_host: cap on simultaneous requests to the website, defaults to the shared client's cap
+    :param client: HttpClient to download with, defaults to the shared http_client (or a new one when max_per_host is
+    given)
+    :param cache: optional PageCache, days already cached are read from disk instead of the website
+    :param coordinates: optional dict, filled with station: (lon, lat) read from the first page that has them, so the
+    coordinates come for free with the rain data
+    :param range_days: days asked for per request, pages that cannot be split back into days are fetched per day
+    :param batch_days: days of rows converted and written together
+    :param frames: optional dict, filled with station: the typed table (parsed datetimes, float32 rain) so it can go
+    straight to fill_excel without reading the csv back
+    :param progress: optional callable, given a ProgressEvent after every finished day
+    :param control: optional JobControl to pause or cancel the download, a cancelled download raises JobCancelled and
+    leaves <station>.csv untouched
+    :param manifest: optional JobManifest, every written batch is checkpointed in it and a station left half done by an
+    earlier run continues after its last checkpointed day
+    :param keep_earlier: keep the rows of an existing <station>.csv dated before start_date, the downloaded days replace
+    the rest of the file (the update mode of process_station)
+    :param formats: storage formats the rows are written to, any of STORAGE_FORMATS: csv gives <station>.csv, parquet
+    and feather add the station to the partitioned dataset rain.parquet or rain.feather
+    :param skipped: optional dict, filled with station: the days ("%Y-%m-%d") skipped without a request because the
+    cache knows they have no data, or ['all'] when the whole range is known to be empty
     :return: a list of rain gauge names that are not available
     on the webiste
     '''
-    dfs = []
+    if client is None:
+        client = HttpClient(max_per_host=max_per_host) if max_per_host else http_client
     NA_station = []
-    for single_date in daterange(start_date, end_date):
-        try:
-            df_single = fetch_one_day(station, single_date.strftime("%Y-%m-%d"), paccumchoice,savefolder)
-        # df_single.to_csv(savefolder + '/' + station +'.csv', index=False)
-            dfs.append(df_single)
-        except KeyError:
-            print(f'Oops, The data for Station {station} is not available at {single_date}, please check the website and consider changing the '
-                  f'date range or just skipping this station.')
+    if cache is not None and cache.station_is_empty(station, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")):
+        print(f'Station {station} had no data from {start_date:%Y-%m-%d} to {end_date:%Y-%m-%d} in a recent run, skipping it')
+        if skipped is not None:
+            skipped[station] = ['all']
+        NA_station.append(station)
+        return NA_station
+    rows = 0
+    resume_sizes = {}
+    if manifest is not None:
+        state = manifest.station(station, start_date, end_date)
+        if state['last_day'] and set(state['sizes']) == set(formats) and all(
+                0 < size <= part_output_size(file_format, savefolder, station)
+                for file_format, size in state['sizes'].items()):
+            print(f'Resuming Station {station} after {state["last_day"]}')
+            resume_sizes = state['sizes']
+            rows = state['rows']
+            start_date = datetime.datetime.strptime(state['last_day'], "%Y-%m-%d") + datetime.timedelta(1)
+    writers = []
+    try:
+        for file_format in formats:
+            writers.append(open_station_writer(file_format, savefolder, station, resume_sizes.get(file_format, 0),
+                                               start_date if keep_earlier else None))
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    if not resume_sizes:
+        rows = writers[0].rows
+    # a resumed or updated station only has its new rows in memory, so fill_excel reads it back from the files instead
+    keep_frames = frames is not None and not any(writer.written for writer in writers)
+    batch = [[], [], []]
+    batch_count = 0
+    typed_batches = []
+
+    def write_batch(last_day):
+        df_batch = rain_frame(*batch)
+        typed_batch = None
+        if keep_frames or any(writer.typed for writer in writers):
+            typed_batch = parse_datetimes(df_batch)
+        for writer in writers:
+            writer.append(typed_batch if writer.typed else df_batch)
+        if keep_frames:
+            typed_batches.append(typed_batch)
+        if manifest is not None:
+            manifest.record_days(station, last_day, {file_format: writer.checkpoint()
+                                                     for file_format, writer in zip(formats, writers)}, rows)
+
+    windows = list(date_windows(start_date, end_date, range_days))
+    skip = frozenset()
+    if cache is not None:
+        skip = frozenset(cache.empty_days(station, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")))
+        if skipped is not None:
+            skipped[station] = sorted(skip)
+    days_total = sum(len(window) for window in windows)
+    days_done = 0
+    started = time.monotonic()
 
-        try:
-            df_alldays = pd.concat(dfs)
-            df_alldays.to_csv(savefolder + '/'+station + '.csv', index=False)
-        except ValueError:
-            print(f'No data has been collected for {station}')
-            NA_station.append(station)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # map hands the results back in the order of the dates, whatever order the downloads finish in
+            results = pool.map(lambda window: fetch_window(station, window, paccumchoice, savefolder, client, cache, control,
+                                                           skip), windows)
+            for window, days in zip(windows, results):
+                for single_date, (day_rows, coords) in zip(window, days):
+                    days_done += 1
+                    if day_rows is not None:
+                        rows += len(day_rows[0])
+                        for column, values in zip(batch, day_rows):
+                            column.extend(values)
+                        batch_count += 1
+                    if coordinates is not None and coords is not None and station not in coordinates:
+                        coordinates[station] = coords
+                    if batch_count >= batch_days:
+                        write_batch(single_date)
+                        batch = [[], [], []]
+                        batch_count = 0
+                    if progress is not None:
+                        throughput = days_done / max(time.monotonic() - started, 1e-6)
+                        progress(ProgressEvent(station, single_date.strftime("%Y-%m-%d"), days_done, days_total, rows,
+                                               throughput, (days_total - days_done) / throughput))
+        if batch_count:
+            write_batch(end_date)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
+    has_data = all([writer.finalize() for writer in writers])
+    if manifest is not None and has_data:
+        manifest.record_data(station, rows)
+
+    if keep_frames and typed_batches:
+        frames[station] = pd.concat(typed_batches, ignore_index=True)
+
+    if not has_data:
+        print(f'No data has been collected for {station}')
+        NA_station.append(station)
+        if cache is not None:
+            cache.mark_empty_station(station, start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
     return NA_station
 
-def coordinate (station,date):
-    url = 'https://www.wunderground.com/dashboard/pws/' + station.upper() + '/table/' + date + '/' + date + '/daily'
+def coordinate (station,date, cache=None, client=None):
+    '''
+    Find the coordinates of a station, trying the cheap sources first: the app-root-state script of its dashboard page,
+    the other data embedded in the page, the weather.com API, and only then the shared headless browser.
+    '''
     print('fetching coordinate')
-    page = requests.get(url)
-
-    soup = BeautifulSoup(page.content, 'html.parser')
-    #rows = soup.select('.history-table tr')
+    content = fetch_page(station, date, client, cache)
 
     ## finding hidden longitude and latitude
+    coords = (page_coordinates(content) or embedded_coordinates(content, station)
+              or api_coordinates(station, date, content, client))
+    if coords is None:  #if the backend returns nothing, then open the web page and click the detail button
+        coords = shared_browser.coordinates(station, date)
+    if coords is None:
+        raise ValueError(f'No coordinates found for Station {station}')
+    lon, lat = coords
+    print(f'The longitude value for Station {station} is: {lon}')
+    print(f'The latitude value for Station {station} is: {lat}')
+
+    return lon, lat
+
+class StationRegistry:
+    '''
+    Persistent registry of the stations met by any run, in an SQLite file: coordinates, the first and last day of data
+    downloaded, and whether the website has data for the station. Coordinates are indexed in an R*Tree, so "stations
+    within X km" only looks at the stations of the surrounding box (a plain lat/lon index when SQLite lacks R*Tree).
+    '''
+    EARTH_RADIUS_KM = 6371.0
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self._db.execute('CREATE TABLE IF NOT EXISTS stations (id INTEGER PRIMARY KEY, station TEXT UNIQUE, lon REAL, '
+                         'lat REAL, first_day TEXT, last_day TEXT, status TEXT, updated TEXT)')
+        try:
+            self._db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS station_index USING rtree(id, min_lat, max_lat, '
+                             'min_lon, max_lon)')
+            self.rtree = True
+        except sqlite3.OperationalError:
+            self._db.execute('CREATE INDEX IF NOT EXISTS station_lat_lon ON stations (lat, lon)')
+            self.rtree = False
+        self._db.commit()
+
+    def _upsert(self, station, **values):
+        values['updated'] = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        self._db.execute('INSERT OR IGNORE INTO stations (station) VALUES (?)', (station.upper(),))
+        self._db.execute(f'UPDATE stations SET {", ".join(name + "=?" for name in values)} WHERE station=?',
+                         (*values.values(), station.upper()))
+
+    def record(self, station, lon, lat, first_date, last_date):
+        '''
+        Record the coordinates of a station with data, widening its known date range to first_date-last_date (the
+        dates of its first and last rows)
+        '''
+        lon, lat = float(lon), float(lat)
+        with self._lock:
+            known = self._db.execute('SELECT id, first_day, last_day FROM stations WHERE station=?',
+                                     (station.upper(),)).fetchone()
+            first_day, last_day = first_date.strftime("%Y-%m-%d"), last_date.strftime("%Y-%m-%d")
+            if known is not None and known[1] is not None:
+                first_day, last_day = min(first_day, known[1]), max(last_day, known[2])
+            self._upsert(station, lon=lon, lat=lat, first_day=first_day, last_day=last_day, status='available')
+            if self.rtree:
+                row_id = self._db.execute('SELECT id FROM stations WHERE station=?', (station.upper(),)).fetchone()[0]
+                self._db.execute('INSERT OR REPLACE INTO station_index VALUES (?, ?, ?, ?, ?)',
+                                 (row_id, lat, lat, lon, lon))
+            self._db.commit()
+
+    def record_unavailable(self, station):
+        with self._lock:
+            self._upsert(station, status='unavailable')
+            self._db.commit()
+
+    def coordinates(self, station):
+        '''(lon, lat) of a station, None when it was never located'''
+        with self._lock:
+            row = self._db.execute('SELECT lon, lat FROM stations WHERE station=? AND lon IS NOT NULL',
+                                   (station.upper(),)).fetchone()
+        return row
+
+    def table(self, stations=None):
+        '''The registry as a table indexed by station, only the given stations (in their order) when asked'''
+        with self._lock:
+            table = pd.read_sql_query('SELECT station, lon, lat, first_day, last_day, status, updated FROM stations',
+                                      self._db, index_col='station')
+        if stations is not None:
+            table = table.reindex([station.upper() for station in stations])
+        return table
+
+    def within(self, lon, lat, km):
+        '''The located stations within km of a point, nearest first, with their distance_km'''
+        lon, lat = float(lon), float(lat)
+        dlat = np.degrees(km / self.EARTH_RADIUS_KM)
+        dlon = dlat / max(np.cos(np.radians(lat)), 1e-6)
+        box = (lat - dlat, lat + dlat, lon - dlon, lon + dlon)
+        if self.rtree:
+            query = ('SELECT s.station, s.lon, s.lat FROM station_index i JOIN stations s ON s.id = i.id '
+                     'WHERE i.max_lat >= ? AND i.min_lat <= ? AND i.max_lon >= ? AND i.min_lon <= ?')
+            parameters = (box[0], box[1], box[2], box[3])
+        else:
+            query = 'SELECT station, lon, lat FROM stations WHERE lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?'
+            parameters = box
+        with self._lock:
+            near = pd.read_sql_query(query, self._db, params=parameters)
+        # exact great-circle distance of the stations in the box
+        phi, other_phi = np.radians(lat), np.radians(near['lat'].to_numpy())
+        half_dphi = (other_phi - phi) / 2
+        half_dlambda = np.radians(near['lon'].to_numpy() - lon) / 2
+        a = np.sin(half_dphi) ** 2 + np.cos(phi) * np.cos(other_phi) * np.sin(half_dlambda) ** 2
+        near['distance_km'] = 2 * self.EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+        return near[near['distance_km'] <= km].sort_values('distance_km', ignore_index=True)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Function to give the path of the station registry of a save folder, or of a cache folder when there is one
+def registry_path(savefolder, cache_folder=None):
+    return os.path.join(cache_folder or os.path.join(savefolder, 'aquatrack_cache'), 'stations.sqlite')
+
+
+# Function to read the station list csv into (station name, start date, end date) entries
+def read_station_list(stationlist):
+    stations = []
+    with open(stationlist, "r") as file:
+        # Repeat for each station in the .csv file
+        for line in file:
+            if not line.strip():
+                continue
+            # Let's split the line into an array called "fields" using the "," as a separator:
+            fields = line.split(",")
+            # and let's extract the data:
+            stations.append((fields[0], convert(fields[1]), convert(fields[2])))
+    return stations
+
+
+# Function to download and process one station: rain data, coordinates and the processed Excel file
+def process_station(stationName, startDate, endDate, exceltemp, savefolder, progress=None, control=None, cache=None,
+                    manifest_path=None, update=False, formats=('csv',), empty_ttl_days=EMPTY_TTL_DAYS, cache_folder=None,
+                    max_workers=MAX_WORKERS, excel_mode='formulas', rain_summary=True,
+                    inter_event_hours=INTER_EVENT_HOURS, range_days=1, min_interval=0.0):
+    '''
+    The unit of work of the station scheduler. Any error is caught and reported in the result, so one failing station
+    never stops the others; only a cancelled job raises JobCancelled.
+
+    With manifest_path, each finished step is recorded in that JobManifest and a rerun picks up where the station
+    stopped: a finished station is skipped (unless its Excel file was written from another template, excel_mode,
+    rain_summary or inter_event_hours), finished data goes straight to Excel, a half-downloaded station continues after
+    its last checkpointed day.
+
+    With update, the station's saved data is brought up to today: only the days from its last day on are downloaded
+    (the last day again, it may have been saved before it ended) and merged into it, then the Excel file is rewritten.
+    The manifest never counts an update as finished: only a half-downloaded update continues after its checkpoint.
+
+    The rows are saved in every storage format of formats (see collect_all_days); the first one is the reference for
+    the update mode.
+
+    Days the cache knows to have no data are skipped (see PageCache, empty_ttl_days) and counted in skipped_days; a
+    station whose whole range is known to be empty gets the status 'known empty' without a request.
+
+    :return: dict with the station's status ('done', 'no data', 'known empty' or 'failed'), rows, coordinates, retries,
+    skipped days and timings
+
+    cache_folder holds the page cache (when no cache is given) and the station registry, <savefolder>/aquatrack_cache by
+    default; max_workers is the number of days downloaded at the same time; range_days is the number of days asked for
+    per request (see collect_all_days); excel_mode is the mode of fill_excel; min_interval is the least number of
+    seconds between two requests to the same host (see HttpClient), 0 for no spacing.
+    With rain_summary, the station's rainfall events, fixed-interval totals and flagged readings are saved too
+    (write_rain_summary), events being separated by inter_event_hours without rain.
+    '''
+    report = progress or (lambda message: None)
+    http_client.min_interval = min_interval
+    result = {'station': stationName, 'status': 'failed', 'rows': 0, 'retries': 0, 'skipped_days': 0, 'skipped': '',
+              'events': 0, 'flagged': 0, 'download_s': 0.0, 'excel_s': 0.0, 'lon': None, 'lat': None, 'error': ''}
+    own_cache = cache is None
+    if own_cache:
+        # pages of completed days are kept here so a re-run only downloads the days it has not seen yet
+        cache = PageCache(cache_folder or os.path.join(savefolder, 'aquatrack_cache'), empty_ttl_days)
+    manifest = JobManifest(manifest_path) if manifest_path else None
+    registry = StationRegistry(registry_path(savefolder, cache_folder))
+    station_coordinates = {}
+    station_frames = {}
+    station_skips = {}
     try:
-        test = soup.find_all("script", attrs={'id': 'app-root-state'})
-        test_content = test[0].contents[0]
+        if control is not None:
+            control.checkpoint()
+        if update:
+            endDate = datetime.datetime.combine(datetime.date.today(), datetime.time())
+            last_day = last_saved_day(formats[0], savefolder, stationName)
+            if last_day is not None:
+                startDate = max(startDate, last_day)
+        excel = excel_settings(exceltemp, excel_mode, rain_summary, inter_event_hours)
+        state = manifest.station(stationName, startDate, endDate, excel) if manifest is not None else {}
+        if state.get('lon') is not None:
+            station_coordinates[stationName] = (state['lon'], state['lat'])
+        # an update always downloads again: its range ends today, and today's rows are still coming in
+        if not update and state.get('excel_done') and os.path.isfile(savefolder + '/' + stationName + '_processed.xlsx'):
+            report(f'{stationName} was finished by an earlier run')
+            result.update(status='done', rows=state['rows'], lon=state['lon'], lat=state['lat'],
+                          events=state['events'] or 0, flagged=state['flagged'] or 0)
+            return result
+
+        if not update and state.get('data_done') and all(station_output_exists(file_format, savefolder, stationName)
+                                          for file_format in formats):
+            report(f'{stationName} data was finished by an earlier run')
+            result['rows'] = state['rows']
+        else:
+            print("Get " + stationName + " from: " + startDate.strftime("%Y-%m-%d") + " to: " + endDate.strftime("%Y-%m-%d"))
+            report(f'Downloading {stationName}')
+            started = time.monotonic()
+            # collect rain data and the rain gauge coordination
+            NA_station = collect_all_days(stationName, startDate, endDate, "Yes", savefolder, max_workers, cache=cache,
+                                          coordinates=station_coordinates, frames=station_frames,
+                                          progress=progress, control=control, manifest=manifest,
+                                          keep_earlier=update, formats=formats, skipped=station_skips,
+                                          range_days=range_days)
+            result['download_s'] = time.monotonic() - started
+            skips = station_skips.get(stationName, [])
+            result['skipped'] = ' '.join(skips)
+            if skips == ['all']:
+                result['status'] = 'known empty'
+                return result
+            result['skipped_days'] = len(skips)
+            if stationName in NA_station:
+                print(f'The Station {stationName} is not not available on the website')
+                registry.record_unavailable(stationName)
+                result['status'] = 'no data'
+                return result
+
+        # a station located by an earlier run is not looked up again
+        coordinates = station_coordinates.get(stationName) or registry.coordinates(stationName)
+        if coordinates is None:
+            coordinates = coordinate(stationName, startDate.strftime("%Y-%m-%d"), cache=cache)
+        result['lon'], result['lat'] = coordinates
+        if manifest is not None:
+            manifest.record_coordinates(stationName, *coordinates)
+
+        data = station_frames.pop(stationName, None)
+        data = read_station_data(stationName, savefolder, formats) if data is None else as_csv_floats(data)
+        result['rows'] = len(data)
+        # the dates the station has data for, rather than the range the list asked for
+        registry.record(stationName, *coordinates, data['datetime'].min(), data['datetime'].max())
+        report(f'Writing {stationName}_processed.xlsx')
+        started = time.monotonic()
+        fill_excel(stationName, exceltemp, savefolder, streaming=True, data=data, mode=excel_mode,
+                   inter_event_hours=inter_event_hours)
+        if rain_summary:
+            events, flags = write_rain_summary(stationName, savefolder, data, inter_event_hours)
+            result['events'], result['flagged'] = len(events), len(flags)
+        result['excel_s'] = time.monotonic() - started
+        if manifest is not None:
+            manifest.record_excel(stationName, excel, result['events'], result['flagged'])
+        result['status'] = 'done'
+    except JobCancelled:
+        raise
+    except Exception as error:
+        print(f'Station {stationName} failed: {error!r}')
+        result['error'] = repr(error)
+    finally:
+        result['retries'] = http_client.retry_counts.get(stationName.upper(), 0)
+        if own_cache:
+            cache.close()
+        if manifest is not None:
+            manifest.close()
+        registry.close()
+    return result
+
+
+# Function to run process_station in a worker process, with progress sent back through a queue
+def process_station_in_worker(stationName, startDate, endDate, exceltemp, savefolder, events, control, options,
+                              slots=None):
+    if slots:
+        http_client.limiter.share(slots)
+    try:
+        return process_station(stationName, startDate, endDate, exceltemp, savefolder, events.put, control, **options)
+    except JobCancelled:
+        return dict(station=stationName, status='cancelled')
 
-        pattern_lon = re.compile(r"lon&q;:(.*?),&q;")
-        pattern_lat = re.compile(r"lat&q;:(.*?),&q;")
-        lon = (pattern_lon.findall(test_content)[0])
-        lat = (pattern_lat.findall(test_content)[0])
-        print(f'The longitude value for Station {station} is: {lon}')
-        print(f'The latitude value for Station {station} is: {lat}')
-    except:  #if the backend returns nothing, then mannually open the web page and click the detail button
-        path = "C:\Program Files (x86)\chromedriver.exe"
-        driver = webdriver.Chrome(path)
-        driver.get('url')
 
-        time.sleep(2)
-        button = driver.find_element_by_xpath(
-            '//*[@id="inner-content"]/div[1]/app-dashboard-header/div[2]/div/div[2]/div/lib-pws-info-icon/mat-icon')
-        button.click()
+# Function to forward the events of worker processes to the progress callback, until the None sentinel arrives
+def forward_events(events, progress):
+    while True:
+        event = events.get()
+        if event is None:
+            return
+        progress(event)
 
-        divs = driver.find_element_by_class_name('cdk-overlay-container')
 
-        a = divs.text
-        b = list(filter(lambda x: 'Latitude / Longitude' in x, a.split('\n')))[0]
+# Function to run process_station for many stations at once across a process pool
+def run_stations_in_processes(stations, exceltemp, savefolder, progress, control, station_workers, **options):
+    '''
+    Each station runs in its own process, so one station's downloads (threads waiting on the network) overlap with
+    another's Excel generation (CPU bound). Each process has its own fetch thread pool, but the per-host cap of the
+    SHARED_HOSTS is one set of manager semaphores held by all of them, so the whole run never has more than
+    MAX_REQUESTS_PER_HOST requests in flight to the website.
 
-        Num = re.findall(r'[0-9]+', b)
-        lat = int(Num[0]) + int(Num[1]) * 0.001
-        lon = -int(Num[2]) - int(Num[3]) * 0.001
+    :param options: keyword arguments of process_station, the same for every station; min_interval is spread over the
+    processes, each spacing its own requests station_workers times as far apart
+    '''
+    report = progress or (lambda message: None)
+    if options.get('min_interval'):
+        options = dict(options, min_interval=options['min_interval'] * station_workers)
+    results = {}
+    with multiprocessing.Manager() as manager:
+        events = manager.Queue()
+        remote_control = JobControl(manager)
+        slots = {host: manager.BoundedSemaphore(http_client.limiter.max_per_host) for host in SHARED_HOSTS}
+        done = threading.Event()
+        threads = [threading.Thread(target=forward_events, args=(events, report), daemon=True)]
+        if control is not None:
+            threads.append(threading.Thread(target=control.mirror_to, args=(remote_control, done), daemon=True))
+        for thread in threads:
+            thread.start()
+        try:
+            with ProcessPoolExecutor(max_workers=station_workers) as pool:
+                futures = {pool.submit(process_station_in_worker, stationName, startDate, endDate, exceltemp,
+                                       savefolder, events, remote_control, options, slots): stationName
+                           for stationName, startDate, endDate in stations}
+                for future in as_completed(futures):
+                    stationName = futures[future]
+                    try:
+                        results[stationName] = future.result()
+                    except Exception as error:  # the worker process itself died
+                        results[stationName] = dict(station=stationName, status='failed', error=repr(error))
+                    report(f'{stationName}: {results[stationName]["status"]}')
+        finally:
+            done.set()
+            events.put(None)
+            for thread in threads:
+                thread.join()
+    return [results[stationName] for stationName, _, _ in stations]
+
+
+# Function to run the whole download for a station list: rain data, coordinates, processed Excel and kmz
+def run_station_list(stationlist, exceltemp, savefolder, progress=None, control=None, station_workers=1, resume=True,
+                     update=False, formats=('csv',), empty_ttl_days=EMPTY_TTL_DAYS, cache_folder=None,
+                     max_workers=MAX_WORKERS, excel_mode='formulas', rain_summary=True,
+                     inter_event_hours=INTER_EVENT_HOURS, range_days=1, min_interval=0.0):
+    '''
+    :param stationlist: csv file listing station name, start date and end date per line
+    :param exceltemp: the CUMULATIVE REMOVE formula.xlsx template
+    :param savefolder: folder the csv, xlsx, coordinate and kmz files are saved to
+    :param progress: optional callable, given a ProgressEvent for every finished day and a text message per step
+    :param control: optional JobControl to pause or cancel the run between days and stations
+    :param station_workers: number of stations processed at the same time, each in its own process
+    :param resume: keep checkpoints in <list>_manifest.sqlite and continue an earlier run of the same list from its
+    first unfinished unit of work
+    :param update: bring the existing station csv files up to today, downloading only the days they do not have yet
+    :param formats: storage formats the station data is saved in, any of STORAGE_FORMATS
+    :param empty_ttl_days: days a station-day or station found to have no data is skipped without asking the website
+    :param cache_folder: folder of the page cache and the station registry, <savefolder>/aquatrack_cache by default
+    :param max_workers: number of days of a station downloaded at the same time
+    :param excel_mode: 'formulas' or 'values', see fill_excel
+    :param rain_summary: save the rainfall events, fixed-interval totals and flagged readings of every station, and
+    <list>_events.csv with the events of all of them
+    :param inter_event_hours: dry hours between two rainfall events
+    :param range_days: days asked for per request, 1 for one page per day (see collect_all_days)
+    :param min_interval: least number of seconds between two requests to the same host, across all station workers
+    :return: the summary table, one row per station with its status and timings
+    RG data file from on the list
+    kmz file for all the RGs on the list
+    '''
+    report = progress or (lambda message: None)
+    stations = read_station_list(stationlist)
+    listname = os.path.split(stationlist)[1].split('.')[0]
+    manifest_path = savefolder + '/' + listname + '_manifest.sqlite' if resume else None
+    cache_folder = cache_folder or os.path.join(savefolder, 'aquatrack_cache')
+    options = dict(manifest_path=manifest_path, update=update, formats=formats, empty_ttl_days=empty_ttl_days,
+                   cache_folder=cache_folder, max_workers=max_workers, excel_mode=excel_mode,
+                   rain_summary=rain_summary, inter_event_hours=inter_event_hours, range_days=range_days,
+                   min_interval=min_interval)
+
+    if station_workers > 1:
+        results = run_stations_in_processes(stations, exceltemp, savefolder, progress, control, station_workers,
+                                            **options)
+    else:
+        results = []
+        cache = PageCache(cache_folder, empty_ttl_days)
+        try:
+            for stationName, startDate, endDate in stations:
+                try:
+                    results.append(process_station(stationName, startDate, endDate, exceltemp, savefolder, progress,
+                                                   control, cache, **options))
+                except JobCancelled:
+                    results.append(dict(station=stationName, status='cancelled'))
+                    results.extend(dict(station=name, status='cancelled') for name, _, _ in stations[len(results):])
+                    break
+        finally:
+            cache.close()
+
+    summary = pd.DataFrame(results, columns=['station', 'status', 'rows', 'retries', 'skipped_days', 'skipped',
+                                             'events', 'flagged', 'download_s', 'excel_s', 'lon', 'lat', 'error'])
+    summary.to_csv(savefolder + '/' + listname + '_summary.csv', index=False)
+    print(summary.drop(columns=['skipped', 'lon', 'lat']).to_string(index=False))
+    report(', '.join(f'{count} {status}' for status, count in summary['status'].value_counts().items()))
+
+    all_events = None
+    if rain_summary:
+        station_events = [pd.read_csv(savefolder + '/' + station + '_events.csv').assign(station=station)
+                          for station in summary.loc[summary['status'] == 'done', 'station']
+                          if os.path.isfile(savefolder + '/' + station + '_events.csv')]
+        if station_events:
+            all_events = pd.concat(station_events, ignore_index=True)
+            all_events[['station'] + [name for name in all_events.columns if name != 'station']].to_csv(
+                savefolder + '/' + listname + '_events.csv', index=False)
+
+    # the coordinates of the list's stations, including those located by earlier runs
+    registry = StationRegistry(registry_path(savefolder, cache_folder))
+    located = registry.table([station for station, _, _ in stations]).dropna(subset=['lon', 'lat'])
+    registry.close()
+    if len(located):
+        df_coordinate_all = pd.DataFrame({'Longitude (Degree)': located['lon'].to_numpy(),
+                                          'Latitude (Degree)': located['lat'].to_numpy()},
+                                         index=[station for station, _, _ in stations
+                                                if station.upper() in located.index])
+        # save the coordination file
+        df_coordinate_all.to_csv(savefolder + '/'+listname+'_coordinates.csv')
+
+        # Making KML file, with the date range and the rain of each station
+        details = pd.DataFrame({'lon': located['lon'].to_numpy(), 'lat': located['lat'].to_numpy(),
+                                'first_day': located['first_day'].to_numpy(),
+                                'last_day': located['last_day'].to_numpy()}, index=df_coordinate_all.index)
+        if all_events is not None:
+            rain = all_events.groupby('station').agg(total_depth=('depth', 'sum'),
+                                                     max_intensity=('peak_intensity', 'max'))
+            details = details.join(rain.round(3))
+        kml_making(details, savefolder, stationlist)
+
+    if control is not None and control.cancelled:
+        raise JobCancelled()
+    return summary
+
+
+# Placemarks formatted and written to a kmz at a time
+KML_CHUNK_ROWS = 5000
+
+
+# Function to turn a column into text safe inside kml elements
+def kml_text(values):
+    # astype(str) keeps NaN as a float in pandas 3, so each value is turned into text on its own
+    return values.map(lambda value: escape(str(value)))
+
+
+# Function to write stations as the placemarks of a compressed kml (.kmz) file
+def write_kmz(stations, path, name='', chunk_rows=KML_CHUNK_ROWS):
+    '''
+    The kml is streamed straight into the zip file, KML_CHUNK_ROWS placemarks at a time, each chunk formatted with
+    whole-column string operations; the document is never held in memory and thousands of gauges take well under a
+    second.
+
+    :param stations: table indexed by station name with lon and lat columns; its other columns are attached to the
+    placemarks as ExtendedData, leaving out blank values
+    :param path: the .kmz file
+    :param name: name of the kml document
+    '''
+    data_columns = [column for column in stations.columns if column not in ('lon', 'lat')]
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as kmz, kmz.open('doc.kml', 'w') as raw, \
+            io.TextIOWrapper(raw, encoding='utf-8') as kml:
+        kml.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2"><Document>'
+                  f'<name>{escape(name)}</name>\n')
+        for begin in range(0, len(stations), chunk_rows):
+            chunk = stations.iloc[begin:begin + chunk_rows].reset_index(drop=True)
+            names = kml_text(stations.index[begin:begin + chunk_rows].to_series(index=chunk.index))
+            extended = pd.Series('', index=chunk.index)
+            for column in data_columns:
+                data = f'<Data name="{escape(str(column))}"><value>' + kml_text(chunk[column]) + '</value></Data>'
+                extended += data.where(chunk[column].notna(), '')
+            placemarks = ('<Placemark><name>' + names + '</name><ExtendedData>' + extended + '</ExtendedData>'
+                          '<Point><coordinates>' + chunk['lon'].round(6).astype(str) + ','
+                          + chunk['lat'].round(6).astype(str) + '</coordinates></Point></Placemark>\n')
+            kml.writelines(placemarks)
+        kml.write('</Document></kml>\n')
+
+
+# Making kml file, written compressed as <list>.kmz
+def kml_making(stations, savefolder, stationlist):
+    '''
+    :param stations: table indexed by station name with lon and lat columns, and the details to show with each station
+    '''
+    listname = os.path.split(stationlist)[1].split('.')[0]
+    write_kmz(stations, savefolder + '/' + listname + '.kmz', listname)
 
-        print(f'The longitude value for Station {station} is: {lon}')
-        print(f'The latitude value for Station {station} is: {lat}')
-        time.sleep(1)
-        driver.quit()
 
-    return lon, lat
+# Template columns whose row 10 formulas are copied down every data row of the CUMULATIVE REMOVE sheet
+FORMULA_COLUMNS = ['D', 'E', 'F', 'H', 'I', 'J', 'K', 'L']
+FORMULA_ROW = 10
+# Sheet row of the data header, the data itself starts one row below
+HEADER_ROW = 6
+# Columns of cumulative_remove written in place of the template formulas when fill_excel writes values; check_rain.py
+# compares them with what the template's own formulas give
+VALUE_COLUMNS = {'D': 'increment', 'E': 'reset', 'F': 'cumulative', 'H': 'keep', 'I': 'event', 'J': 'event_depth',
+                 'K': 'event_hours', 'L': 'intensity'}
+
+
+# Flags deaccumulate gives the readings that break the daily accumulation, worth a look in the station's data
+DEACCUMULATION_FLAGS = ['missing', 'gauge reset', 'drop']
+
+
+# Function to turn the daily paccum of a station table into the rain of each reading
+def deaccumulate(a, drops_reset=False):
+    '''
+    paccum is the rain since midnight: the first reading of a day is the rain of the day so far, every later one adds
+    what it rose above the highest paccum seen earlier in the day. The readings that break this are flagged:
+
+    missing: no paccum; the previous one of the day is carried, the next reading picks its rain up
+    gauge reset: paccum fell to 0 within the day, the gauge restarted and accumulates again from there
+    drop: paccum fell below an earlier reading of the day without reaching 0, a sensor glitch; it adds no rain and the
+    readings after it only add what rises above the earlier level, so the glitch is not counted twice
+
+    With drops_reset, paccum is read the way the template's D formula reads it: every fall of paccum, glitch or not,
+    starts the accumulation again, the reading after it adding its whole paccum. The flags are the same either way.
+
+    The whole series, any number of days long, is done in one set of whole-array steps.
+
+    :return: table of increment (inches), reset (1 where the accumulation starts again: a new day or a gauge reset, and
+    a drop with drops_reset) and flag ('day reset' on the first reading of a day, one of DEACCUMULATION_FLAGS, or
+    blank), on the index of a
+    '''
+    times = a['datetime'].to_numpy(dtype='datetime64[ns]')
+    day = times.astype('datetime64[D]')
+    new_day = np.r_[True, day[1:] != day[:-1]]
+    raw = a['paccum'].to_numpy(dtype=float)
+    missing = np.isnan(raw)
+    # grouping on sorted integer day numbers is several times faster than on the dates
+    paccum = pd.Series(raw).groupby(np.cumsum(new_day)).ffill().fillna(0).to_numpy()
+    gauge_reset = ~new_day & ~missing & (paccum == 0) & (np.r_[0.0, paccum[:-1]] > 0)
+    reset = new_day | gauge_reset
+    # the highest paccum of each accumulation so far, which a glitch does not lower
+    level = pd.Series(paccum).groupby(np.cumsum(reset)).cummax().to_numpy()
+    previous = np.r_[0.0, level[:-1]]
+    drop = ~reset & ~missing & (paccum < previous)
+    flag = np.select([missing, gauge_reset, drop, new_day], DEACCUMULATION_FLAGS + ['day reset'], '')
+    if drops_reset:
+        previous = np.r_[0.0, paccum[:-1]]
+        reset = new_day | (paccum < previous)
+        level = paccum
+    # rounded to the 0.001 inch resolution of the readings, which drops the float noise of the subtraction
+    increment = np.round(np.where(reset, level, level - previous), 3)
+    return pd.DataFrame({'increment': increment, 'reset': reset.astype(np.int8), 'flag': flag}, index=a.index)
+
+
+# Function to compute the CUMULATIVE REMOVE columns of a station table with NumPy instead of Excel formulas
+def cumulative_remove(a, inter_event_hours=INTER_EVENT_HOURS, drops_reset=False):
+    '''
+    paccum is the rain accumulated since midnight, so it starts again every day; deaccumulate turns it into the rain of
+    each reading (with drops_reset as the template formulas do, for the values mode of fill_excel). All columns are
+    computed in whole-array steps, for any number of rows:
+
+    increment (D): rain since the previous reading, see deaccumulate
+    reset (E): 1 on the rows where paccum started again (a new day or a gauge reset)
+    cumulative (F): running total of increment
+    keep (H): 'Keep' for rows with rain (increment > 0), 'Remove' for the others
+    event (I): number of the rainfall event of a Keep row; a new event starts after inter_event_hours without rain
+    event_depth (J), event_hours (K): total rain and duration of that event, from the reading before its first rain
+    (unless that one is more than inter_event_hours earlier) to its last rain
+    intensity (L): increment over the time since the previous reading, inches per hour (blank after a gap of more than
+    inter_event_hours, whose rain cannot be timed)
+    flag: the deaccumulate flag of the reading
+
+    :return: table of these columns, on the index of a
+    '''
+    times = a['datetime'].to_numpy(dtype='datetime64[ns]')
+    rain = deaccumulate(a, drops_reset)
+    increment = rain['increment'].to_numpy()
+
+    hours = np.r_[np.nan, np.diff(times) / np.timedelta64(1, 'h')]
+    timed = (hours > 0) & (hours <= inter_event_hours)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intensity = np.where(timed, increment / hours, np.nan)
+
+    keep = increment > 0
+    rain_rows = np.flatnonzero(keep)
+    starts = np.r_[True, np.diff(times[rain_rows]) >= np.timedelta64(int(inter_event_hours * 3600), 's')]
+    rain_event = np.cumsum(starts)
+    event = np.full(len(a), np.nan)
+    event[rain_rows] = rain_event
+    event_depth = np.full(len(a), np.nan)
+    event_hours = np.full(len(a), np.nan)
+    if len(rain_rows):
+        depth = np.bincount(rain_event, weights=increment[rain_rows])
+        ends = np.r_[starts[1:], True]
+        first, last = rain_rows[starts], rain_rows[ends]
+        # the rain of the first reading fell since the reading before it
+        lead = np.where(timed[first], hours[first], 0.0)
+        duration = np.r_[0.0, (times[last] - times[first]) / np.timedelta64(1, 'h') + lead]
+        event_depth[rain_rows] = np.round(depth[rain_event], 3)
+        event_hours[rain_rows] = duration[rain_event]
+
+    return pd.DataFrame({'increment': increment, 'reset': rain['reset'].to_numpy(), 'cumulative': np.round(np.cumsum(increment), 3),
+                         'keep': np.where(keep, 'Keep', 'Remove'), 'event': event, 'event_depth': event_depth,
+                         'event_hours': event_hours, 'intensity': intensity, 'flag': rain['flag'].to_numpy()},
+                        index=a.index)
+
+
+# Function to list the rainfall events of a station table, one row per event
+def rain_events(a, inter_event_hours=INTER_EVENT_HOURS, computed=None):
+    '''
+    The events are those of cumulative_remove: the readings with rain, split wherever inter_event_hours pass without
+    rain. The readings are grouped in one vectorized step, whatever the number of events.
+
+    :param computed: the cumulative_remove table of a, when it is already there
+    :return: event, start and end (first and last reading with rain), depth, duration_hours and peak_intensity (the
+    highest reading intensity, inches per hour) per event
+    '''
+    if computed is None:
+        computed = cumulative_remove(a, inter_event_hours)
+    rain = computed['event'].notna().to_numpy()
+    readings = pd.DataFrame({'event': computed['event'].to_numpy()[rain].astype(np.int64),
+                             'datetime': a['datetime'].to_numpy()[rain],
+                             'event_depth': computed['event_depth'].to_numpy()[rain],
+                             'event_hours': computed['event_hours'].to_numpy()[rain],
+                             'intensity': computed['intensity'].to_numpy()[rain]})
+    events = readings.groupby('event', sort=False).agg(start=('datetime', 'first'), end=('datetime', 'last'),
+                                                      depth=('event_depth', 'first'),
+                                                      duration_hours=('event_hours', 'first'),
+                                                      peak_intensity=('intensity', 'max'))
+    return events.reset_index()
+
+
+# Function to total the rain of a station table over fixed intervals (a pandas offset such as '5min', '60min', '1D')
+def resample_rain(a, rule, computed=None):
+    if computed is None:
+        computed = cumulative_remove(a)
+    depth = pd.Series(computed['increment'].to_numpy(), index=pd.DatetimeIndex(a['datetime']))
+    # an interval without any reading stays blank, it is missing data rather than dry
+    return depth.resample(rule).sum(min_count=1).round(3).rename('depth').rename_axis('datetime').reset_index()
+
+
+# Function to write the rainfall events, the fixed-interval totals and the flagged readings of a station next to its csv
+def write_rain_summary(stationName, savefolder, a, inter_event_hours=INTER_EVENT_HOURS):
+    '''
+    Saves <station>_events.csv, one <station>_<interval>.csv per RESAMPLE_INTERVALS and <station>_flags.csv (the
+    readings deaccumulate flagged with one of DEACCUMULATION_FLAGS), all from a single cumulative_remove pass over the
+    station's rows.
 
-# Making kml file
-def kml_making(df_coordinate_all, savefolder, stationlist):
-    kml = simplekml.Kml()
-    for n in range(len(df_coordinate_all)):
-        Name = df_coordinate_all.index[n]
-        Coords = [(float(df_coordinate_all.loc[Name,'Longitude (Degree)']), float(df_coordinate_all.loc[Name,'Latitude (Degree)']))]
-        kml.newpoint(name = Name, coords=Coords) # lon, lat, optional height
-        print(Coords)
-    kml.save(savefolder+'/'+os.path.split(stationlist)[1].split('.')[0]+'.kml')
+    :return: the events and flagged readings tables
+    '''
+    computed = cumulative_remove(a, inter_event_hours)
+    events = rain_events(a, inter_event_hours, computed)
+    events.to_csv(savefolder + '/' + stationName + '_events.csv', index=False)
+    for name, rule in RESAMPLE_INTERVALS.items():
+        resample_rain(a, rule, computed).to_csv(savefolder + '/' + stationName + '_' + name + '.csv', index=False)
+    flagged = computed['flag'].isin(DEACCUMULATION_FLAGS).to_numpy()
+    flags = pd.DataFrame({'datetime': a['datetime'].to_numpy()[flagged], 'paccum': a['paccum'].to_numpy()[flagged],
+                          'increment': computed['increment'].to_numpy()[flagged],
+                          'flag': computed['flag'].to_numpy()[flagged]})
+    flags.to_csv(savefolder + '/' + stationName + '_flags.csv', index=False)
+    return events, flags
+
+
+# Function to give the float32 rain columns of an in-memory station table the float64 values its csv holds
+def as_csv_floats(a):
+    if a['paccum'].dtype != np.float32:
+        return a
+    # going through the shortest text of each float32 gives 0.01 rather than 0.009999999776
+    return a.assign(prate=a['prate'].astype(str).astype(float), paccum=a['paccum'].astype(str).astype(float))
+
+
+# Function to read a station csv written by collect_all_days into datetime, prate and paccum columns
+def load_station_csv(path):
+    a = pd.read_csv(path, header=0)
+    # Remove extra headers
+    a = a.drop(a[a['datetime'] == 'datetime'].index)
+    a['datetime'] = pd.to_datetime(a['datetime'], format='%Y-%m-%d %I:%M %p')
+    a.reset_index(inplace=True)
+    a.paccum = a.paccum.astype(float)
+    a.drop(['index'], axis=1, inplace=True) # this is probably no longer needed as we have updated the webscraping code. Now we won't see bunch of 'datatime' rows
+    return a
+
+
+# Function to read a station's saved rows back, from its csv when it is one of formats or else from its dataset
+def read_station_data(stationName, savefolder, formats=('csv',)):
+    if 'csv' in formats:
+        return load_station_csv(savefolder + '/' + stationName + '.csv')
+    return read_station_store(savefolder, stationName, file_format=formats[0])
+
+
+class RowFormula:
+    '''
+    A template formula compiled once into a row-parameterized pattern. Its relative row references become format fields
+    holding an offset from the template row, so the formula of any row is a single str.format instead of a fresh
+    Translator (which tokenizes the formula again) per cell. Columns are never shifted, as the formulas are only copied
+    down their own column.
+    '''
+    CELL = re.compile(r'(\$?[A-Za-z]{1,3}\$?)(\d+)')
+    ROW = re.compile(r'(\$?)(\d+)')
+
+    def __init__(self, formula, origin_row):
+        self.offsets = []
+        if not isinstance(formula, str) or not formula.startswith('='):
+            self.pattern = None
+            self.value = formula
+            return
+        pieces = ['=']
+        for token in Tokenizer(formula).items:
+            if token.type == Token.OPERAND and token.subtype == Token.RANGE:
+                pieces.append(self._compile_range(token.value, origin_row))
+            else:
+                pieces.append(self._escape(token.value))
+        self.pattern = ''.join(pieces)
+
+    @staticmethod
+    def _escape(text):
+        return text.replace('{', '{{').replace('}', '}}')
+
+    def _compile_range(self, value, origin_row):
+        sheet, _, ref = value.rpartition('!')
+        parts = []
+        for part in ref.split(':'):
+            cell = self.CELL.fullmatch(part)
+            row = self.ROW.fullmatch(part)
+            if cell and not cell.group(1).endswith('$'):
+                parts.append(self._escape(cell.group(1)) + '{}')
+                self.offsets.append(int(cell.group(2)) - origin_row)
+            elif row and not row.group(1):
+                parts.append('{}')
+                self.offsets.append(int(row.group(2)) - origin_row)
+            else:  # absolute rows, whole columns and names stay as they are
+                parts.append(self._escape(part))
+        return self._escape(sheet + '!' if sheet else '') + ':'.join(parts)
+
+    def render(self, row):
+        if self.pattern is None:
+            return self.value
+        return self.pattern.format(*[row + offset for offset in self.offsets])
+
+
+# Function to copy a template cell, with its style, into a cell of a write-only sheet
+def copy_template_cell(ws, cell, value=None):
+    new_cell = WriteOnlyCell(ws, value=cell.value if value is None else value)
+    if cell.has_style:
+        new_cell.font = copy(cell.font)
+        new_cell.border = copy(cell.border)
+        new_cell.fill = copy(cell.fill)
+        new_cell.number_format = cell.number_format
+        new_cell.protection = copy(cell.protection)
+        new_cell.alignment = copy(cell.alignment)
+    return new_cell
+
+
+# Function to put a value in a row being built, keeping the template cell (and its style) when there is one
+def set_row_value(values, position, value):
+    if isinstance(values[position], Cell):
+        values[position].value = value
+    else:
+        values[position] = value
+
+
+# Function to set up a write-only sheet with the layout of a template sheet, before any row is written
+def copy_sheet_layout(ws, template):
+    for key, dimension in template.column_dimensions.items():
+        ws.column_dimensions[key].width = dimension.width
+        ws.column_dimensions[key].hidden = dimension.hidden
+    ws.freeze_panes = template.freeze_panes
+    for merged in template.merged_cells.ranges:
+        ws.merged_cells.add(merged.coord)
+
+
+# Function to write the processed workbook of one station in a single streaming pass
+def fill_excel_streaming(stationName, exceltemp, savefolder, data=None, mode='formulas',
+                         inter_event_hours=INTER_EVENT_HOURS):
+    '''
+    Gives the same _processed.xlsx as the template path of fill_excel, but the rows are streamed out through a write-only
+    workbook and the D-L formulas are compiled once (RowFormula) instead of translated per cell, so time and memory stay
+    flat for station-years of 1-minute data. Template cells keep their styles; empty rain values are left blank.
+    Returns the number of data rows written.
+
+    With mode 'values', the D-L cells of every data row get the values of cumulative_remove instead of formulas, so the
+    file opens without a recalculation, and the Remove rows are hidden so that the Keep filter of column H is already
+    applied. Like the formulas, these values take every drop of paccum for a reset (drops_reset); only the rain summary
+    (write_rain_summary) tells a glitch from a gauge reset.
+    '''
+    if data is not None:
+        a = as_csv_floats(data)
+    elif os.path.isfile(savefolder+'/'+ stationName + '.csv'):
+        a = load_station_csv(savefolder+'/'+ stationName + '.csv')
+    else:
+        return
+
+    template_wb = load_workbook(exceltemp)
+    template = template_wb.active
+    formulas = [(column, RowFormula(template[f'{column}{FORMULA_ROW}'].value, FORMULA_ROW)) for column in FORMULA_COLUMNS]
+    formula_positions = [ord(column) - ord('A') for column, _ in formulas]
+    if mode == 'values':
+        computed = cumulative_remove(a, inter_event_hours, drops_reset=True)
+        computed = computed[[VALUE_COLUMNS[column] for column in FORMULA_COLUMNS]]
+        # cell values per data row, in the order of FORMULA_COLUMNS, blanks for NaN
+        value_rows = computed.astype(object).where(computed.notna(), None).to_numpy()
+        hidden = (computed['keep'] == 'Remove').to_numpy()
+
+    wb = Workbook(write_only=True)
+    for template_ws in template_wb.worksheets:
+        ws = wb.create_sheet(template_ws.title)
+        copy_sheet_layout(ws, template_ws)
+        if template_ws is not template:
+            for row in template_ws.iter_rows():
+                ws.append([copy_template_cell(ws, cell) for cell in row])
+            continue
+
+        last_row = HEADER_ROW + len(a)
+        max_row = max(last_row, template.max_row)
+        data_rows = a.itertuples(index=False, name=None)
+        for r_idx in range(1, max_row + 1):
+            values = []
+            if r_idx <= template.max_row:
+                values = [copy_template_cell(ws, cell) for cell in template[r_idx]]
+            if HEADER_ROW <= r_idx <= last_row:
+                data = list(a.columns) if r_idx == HEADER_ROW else [None if pd.isna(value) else value for value in next(data_rows)]
+                first_computed_row = HEADER_ROW if mode == 'values' else FORMULA_ROW
+                width = max(len(values), len(data), formula_positions[-1] + 1 if r_idx > first_computed_row else 0)
+                values.extend([None] * (width - len(values)))
+                for c_idx, value in enumerate(data):
+                    set_row_value(values, c_idx, value)
+                if r_idx > HEADER_ROW and mode == 'values':
+                    for position, value in zip(formula_positions, value_rows[r_idx - HEADER_ROW - 1]):
+                        set_row_value(values, position, value)
+                    if hidden[r_idx - HEADER_ROW - 1]:
+                        ws.row_dimensions[r_idx].hidden = True
+                elif r_idx > FORMULA_ROW:
+                    for position, (column, formula) in zip(formula_positions, formulas):
+                        set_row_value(values, position, formula.render(r_idx))
+            ws.append(values)
+
+        ws.auto_filter.ref = f'H7:L{max_row}'
+        ws.auto_filter.add_filter_column(0, ['Keep'], blank = False)
+        ws.auto_filter.add_sort_condition(f'H7:H{max_row}')
+    wb.active = template_wb.worksheets.index(template)
+    wb.save(savefolder+'/'+ stationName+"_processed.xlsx")
+    return len(a)
 
 
-def fill_excel(stationName,exceltemp, savefolder):
+def fill_excel(stationName,exceltemp, savefolder, streaming=False, data=None, mode='formulas',
+               inter_event_hours=INTER_EVENT_HOURS):
+    '''
+    Fill the CUMULATIVE REMOVE template with a station's data and save it as <station>_processed.xlsx
+
+    :param streaming: write through fill_excel_streaming, the fast path for large stations
+    :param data: the station's typed table from collect_all_days(frames=...), read from <station>.csv when not given
+    :param mode: 'formulas' copies the template formulas down every row (for auditing the sheet in Excel), 'values'
+    writes the results of cumulative_remove instead (always streamed)
+    :param inter_event_hours: dry hours between two rainfall events, for the values mode
+    '''
+    if streaming or mode == 'values':
+        return fill_excel_streaming(stationName, exceltemp, savefolder, data, mode, inter_event_hours)
     wb = load_workbook(exceltemp)
     ws = wb.active
     #  import station data
-    if os.path.isfile(savefolder+'/'+ stationName + '.csv'):
-        a = pd.read_csv(savefolder+'/'+ stationName + '.csv', header=0)
-        # Remove extra headers
-        a = a.drop(a[a['datetime'] == 'datetime'].index)
-        a['datetime'] = pd.to_datetime(a['datetime'], format='%Y-%m-%d %I:%M %p')
-        a.reset_index(inplace=True)
-        a.paccum = a.paccum.astype(float)
-        a.drop(['index'], axis=1, inplace=True) # this is probably no longer needed as we have updated the webscraping code. Now we won't see bunch of 'datatime' rows
+    if data is not None or os.path.isfile(savefolder+'/'+ stationName + '.csv'):
+        a = as_csv_floats(data) if data is not None else load_station_csv(savefolder+'/'+ stationName + '.csv')
         #  Convert excel rows
         rows = dataframe_to_rows(a, index=False)
         # fill the excel table
@@ -202,22 +2070,314 @@ def fill_excel(stationName,exceltemp, savefolder):
 
 
 
-def get_idf():
-    coordinate_list = tkinter.filedialog.askopenfilename(
-        title='Select the coordinate list file')
-    coordinate_pd = pd.read_csv(coordinate_list)
+# Spacing in degrees of the NOAA Atlas 14 grid (30 arc-seconds), gauges in the same grid cell share one IDF download
+IDF_GRID = 30 / 3600
+NOAA_IDF_URL = 'https://hdsc.nws.noaa.gov/cgi-bin/hdsc/new/fe_text_mean.csv'
+# Durations of the NOAA precipitation frequency tables, in hours by their label in the table
+NOAA_DURATIONS = {'5-min': 5 / 60, '10-min': 10 / 60, '15-min': 15 / 60, '30-min': 0.5, '60-min': 1, '2-hr': 2,
+                  '3-hr': 3, '6-hr': 6, '12-hr': 12, '24-hr': 24, '2-day': 48, '3-day': 72, '4-day': 96, '7-day': 168,
+                  '10-day': 240, '20-day': 480, '30-day': 720, '45-day': 1080, '60-day': 1440}
+# Minutes of the bins the station series is totalled in before the NOAA durations are rolled over it
+IDF_STEP_MINUTES = 5
+
+
+# Function to find the NOAA grid cell of a location, as (latitude index, longitude index)
+def idf_grid_cell(lon, lat):
+    return round(float(lat) / IDF_GRID), round(float(lon) / IDF_GRID)
+
 
-    saveto = os.path.dirname(coordinate_list)
+# Function to build the NOAA IDF (precipitation frequency) csv url of a grid cell, asked for at the cell centre
+def idf_url(cell):
+    lat, lon = cell[0] * IDF_GRID, cell[1] * IDF_GRID
+    return (f"{NOAA_IDF_URL}?lat={lat:.6f}&lon={lon:.6f}&data=depth&units=english&series=pds"
+            f"&selAddr=Burlingame, California, USA&selElevNum=511.04&selElevSym=ft&selStaName=-")
 
-    for i in range(len(coordinate_pd)):
-        station_name = coordinate_pd.iloc[i,0]
-        lon = str(coordinate_pd.iloc[i,1])
-        lat = str(coordinate_pd.iloc[i,2])
-        url_csv = f"https://hdsc.nws.noaa.gov/cgi-bin/hdsc/new/fe_text_mean.csv?lat={lat}6&lon={lon}&data=depth&units=english&series=pds&selAddr=Burlingame, California, USA&selElevNum=511.04&selElevSym=ft&selStaName=-"
-        req_csv = requests.get(url_csv)
 
-        with open(f"{saveto}/{station_name}_idf.csv", 'w', encoding=req_csv.encoding) as csvFile:
-            csvFile.write(req_csv.text, )
+class IdfCache:
+    '''
+    On-disk cache of NOAA IDF tables in an SQLite file, keyed by grid cell. The precipitation frequency estimates of a
+    cell do not change, so a cached table never expires.
+    '''
+    def __init__(self, folder):
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, 'idf.sqlite')
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False, timeout=60)
+        self._db.execute('CREATE TABLE IF NOT EXISTS idf '
+                         '(cell_lat INTEGER, cell_lon INTEGER, fetched TEXT, encoding TEXT, content BLOB, '
+                         'PRIMARY KEY (cell_lat, cell_lon))')
+        self._db.commit()
+
+    def get(self, cell):
+        '''The (text, encoding) of a cell's table, None when it is not cached'''
+        with self._lock:
+            row = self._db.execute('SELECT encoding, content FROM idf WHERE cell_lat=? AND cell_lon=?', cell).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[1]).decode('utf-8'), row[0]
+
+    def put(self, cell, text, encoding):
+        fetched = datetime.datetime.utcnow().isoformat(timespec='seconds')
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO idf VALUES (?, ?, ?, ?, ?)',
+                             (*cell, fetched, encoding, zlib.compress(text.encode('utf-8'))))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+# Function to download the IDF table of one grid cell, from the cache when it holds one
+def fetch_idf(cell, tag, client=None, cache=None, control=None):
+    if cache is not None:
+        cached = cache.get(cell)
+        if cached is not None:
+            return cached + (True,)
+    if control is not None:
+        control.checkpoint()
+    req_csv = (client or http_client).get(idf_url(cell), tag=tag)
+    req_csv.raise_for_status()
+    text, encoding = req_csv.text, req_csv.encoding or 'utf-8'
+    if cache is not None:
+        cache.put(cell, text, encoding)
+    return text, encoding, False
+
+
+# Function to tell a station list from a coordinate list by the first line, which is a header only in a coordinate list
+def is_station_list(path):
+    # a station list has a date where a coordinate list has a longitude or its header
+    first = pd.read_csv(path, header=None, nrows=1, dtype=str).iloc[0]
+    return len(first) > 1 and pd.notna(pd.to_datetime(first.iloc[1], errors='coerce'))
+
+
+# Function to download the IDF files of all the RGs of a coordinate list
+def download_idf(coordinate_list, saveto=None, max_workers=MAX_WORKERS, cache_folder=None, progress=None, control=None):
+    '''
+    The gauges are grouped by NOAA grid cell, so duplicate and nearby gauges share one download, and the cells are
+    downloaded by a pool of threads. Cells already in the IdfCache are not downloaded again.
+
+    :param coordinate_list: csv with station name, longitude and latitude per row (the _coordinates.csv of a run), or a
+    station list, whose stations are then located from the StationRegistry of saveto
+    :param saveto: folder the <station>_idf.csv files are saved to, the folder of the coordinate list by default
+    :param max_workers: number of cells downloaded at the same time
+    :param cache_folder: folder of the IdfCache (and of the StationRegistry read for a station list),
+    <saveto>/aquatrack_cache by default
+    :param progress: optional callable, given a text message per finished cell
+    :param control: optional JobControl to pause or cancel the download between cells
+    :return: table of station, cell and whether its IDF came from the cache
+    '''
+    report = progress or (lambda message: None)
+    saveto = saveto or os.path.dirname(coordinate_list)
+    if is_station_list(coordinate_list):
+        registry = StationRegistry(registry_path(saveto, cache_folder))
+        names = [station for station, _, _ in read_station_list(coordinate_list)]
+        located = registry.table(names)
+        registry.close()
+        for station in located.index[located['lon'].isna()]:
+            print(f'Station {station} is not in the station registry, run the RG download first')
+        coordinate_pd = located.dropna(subset=['lon', 'lat']).reset_index()[['station', 'lon', 'lat']]
+    else:
+        coordinate_pd = pd.read_csv(coordinate_list)
+    cache = IdfCache(cache_folder or os.path.join(saveto, 'aquatrack_cache'))
+
+    stations_by_cell = {}
+    for station_name, lon, lat in coordinate_pd.iloc[:, :3].itertuples(index=False, name=None):
+        stations_by_cell.setdefault(idf_grid_cell(lon, lat), []).append(station_name)
+
+    rows = []
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(fetch_idf, cell, station_names[0], http_client, cache, control): cell
+                       for cell, station_names in stations_by_cell.items()}
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    cell = futures[future]
+                    text, encoding, cached = future.result()
+                    for station_name in stations_by_cell[cell]:
+                        with open(f"{saveto}/{station_name}_idf.csv", 'w', encoding=encoding) as csvFile:
+                            csvFile.write(text)
+                        rows.append((station_name, cell, cached))
+                        print(f"{station_name}'s IDF is downloaded")
+                    report(f'IDF {", ".join(map(str, stations_by_cell[cell]))}: cell {done} of {len(futures)}'
+                           f'{" (cached)" if cached else ""}')
+            except BaseException:
+                # cells not started yet are dropped rather than downloaded for nothing
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        cache.close()
+    return pd.DataFrame(rows, columns=['station', 'cell', 'cached'])
+
+
+# Function to read the precipitation frequency table out of a NOAA IDF csv, as saved by download_idf
+def parse_idf(text):
+    '''
+    The file holds a few lines about the location, then the table: a header line "by duration for ARI (years):, 1,2,5,
+    ..." and one line per duration such as "5-min:, 0.123,0.153,...". Only the first table is read (the files with
+    confidence bounds repeat it).
+
+    :return: table of depths (inches), one row per duration label of NOAA_DURATIONS, one column per return period
+    (years); None when the text has no table
+    '''
+    periods, rows = None, {}
+    for line in text.splitlines():
+        label, _, values = line.partition(':')
+        label = label.strip()
+        if periods is None:
+            if 'ARI' in label:
+                periods = [float(value) for value in values.split(',') if value.strip()]
+        elif label in NOAA_DURATIONS and label not in rows:
+            rows[label] = [float(value) for value in values.split(',') if value.strip()][:len(periods)]
+        elif rows:
+            break
+    if not rows:
+        return None
+    return pd.DataFrame.from_dict(rows, orient='index', columns=periods)
+
+
+# Function to load the IDF files of stations into one lookup table
+def read_idf_tables(stations, idf_folder):
+    '''
+    :return: table of depths indexed by (station, duration label), one column per return period; stations without a
+    readable <station>_idf.csv in idf_folder are left out
+    '''
+    tables = {}
+    for station in stations:
+        path = f'{idf_folder}/{station}_idf.csv'
+        table = None
+        if os.path.isfile(path):
+            with open(path, encoding='utf-8', errors='replace') as idf_file:
+                table = parse_idf(idf_file.read())
+        if table is None:
+            print(f'No IDF table for station {station} in {idf_folder}, run the IDF download first')
+            continue
+        tables[station] = table
+    if not tables:
+        return None
+    return pd.concat(tables, names=['station', 'duration'])
+
+
+# Function to find the largest rain depth of every NOAA duration around each event of a station
+def event_depth_maxima(a, events, computed, durations=NOAA_DURATIONS):
+    '''
+    The rain is totalled in IDF_STEP_MINUTES bins, and the depth of every window of each duration is the difference of
+    two values of one running sum, so a duration costs a single array subtraction over the whole series. An event's
+    maximum is the largest window ending within it (from its first to its last rain), taken for all events at once.
+    A window never starts before the first bin of its event, so it holds only the event's own rain and no duration
+    exceeds the event depth.
+    Durations shorter than the usual time between the station's readings cannot be resolved and stay blank.
+
+    :return: array of depths (inches), one row per event, one column per duration
+    '''
+    if not len(events):
+        return np.empty((0, len(durations)))
+    bins = resample_rain(a, f'{IDF_STEP_MINUTES}min', computed)
+    running = np.r_[0.0, np.cumsum(bins['depth'].fillna(0).to_numpy())]
+    bin_times = bins['datetime'].to_numpy()
+    step = f'{IDF_STEP_MINUTES}min'
+    first = np.searchsorted(bin_times, events['start'].dt.floor(step).to_numpy())
+    last = np.searchsorted(bin_times, events['end'].dt.floor(step).to_numpy())
+    # events never share a bin, so their (first, last + 1) bounds are increasing; the sentinel keeps last + 1 in range
+    bounds = np.c_[first, last + 1].ravel()
+    window_ends = np.arange(1, len(running))
+    # the first bin of the event each window ends in, a window starting earlier is cut back to it
+    event_first = np.zeros(len(window_ends), dtype=np.int64)
+    event_first[first] = first
+    event_first = np.maximum.accumulate(event_first)
+    spacing = np.diff(a['datetime'].to_numpy(dtype='datetime64[ns]'))
+    reading_hours = np.median(spacing) / np.timedelta64(1, 'h') if len(spacing) else 0
+    maxima = np.full((len(events), len(durations)), np.nan)
+    for column, hours in enumerate(durations.values()):
+        if hours < reading_hours:
+            continue
+        width = max(1, round(hours * 60 / IDF_STEP_MINUTES))
+        windows = running[window_ends] - running[np.maximum(window_ends - width, event_first)]
+        maxima[:, column] = np.maximum.reduceat(np.r_[windows, 0.0], bounds)[::2]
+    return np.round(maxima, 3)
+
+
+# Function to interpolate the return periods of rain depths on log-log scales between the columns of their IDF rows
+def return_periods(depths, idf_depths, periods):
+    '''
+    :param depths: array of depths
+    :param idf_depths: array of the IDF depths of each depth, one row per depth, one column per return period
+    :param periods: the return periods (years) of the columns
+    :return: array of return periods in years: blank under the smallest period, the largest period above it
+    '''
+    periods = np.log(np.asarray(periods, dtype=float))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_idf = np.log(idf_depths)
+        log_depths = np.log(depths)
+        column = np.clip((log_idf <= log_depths[:, None]).sum(axis=1) - 1, 0, len(periods) - 2)
+        rows = np.arange(len(depths))
+        low, high = log_idf[rows, column], log_idf[rows, column + 1]
+        years = np.exp(periods[column] + (log_depths - low) * (periods[column + 1] - periods[column]) / (high - low))
+    years = np.minimum(years, np.exp(periods[-1]))
+    years[~(depths >= idf_depths[:, 0])] = np.nan
+    return np.round(years, 2)
+
+
+# Function to compare the rainfall events of a station list with the NOAA IDF tables of their gauges
+def compare_idf(stationlist, savefolder, idf_folder=None, formats=('csv',), inter_event_hours=INTER_EVENT_HOURS,
+                progress=None, control=None):
+    '''
+    For every event of every station, the largest depth of each NOAA duration (event_depth_maxima) is given the return
+    period its station's IDF table puts on it. The IDF tables are looked up and interpolated for the events of all the
+    gauges together, in one vectorized pass per duration, and saved as <list>_idf_comparison.csv.
+
+    :param stationlist: csv file listing station name, start date and end date per line
+    :param savefolder: folder of the station data saved by run_station_list
+    :param idf_folder: folder of the <station>_idf.csv files saved by download_idf, savefolder by default
+    :param formats: storage formats of the station data, see read_station_data
+    :param inter_event_hours: dry hours between two rainfall events
+    :param progress: optional callable, given a text message per station
+    :param control: optional JobControl to pause or cancel between stations
+    :return: table of the events with their return_period (the largest over the durations), critical_duration (the
+    duration it is reached at), and the depth and years of each duration
+    '''
+    report = progress or (lambda message: None)
+    listname = os.path.split(stationlist)[1].split('.')[0]
+    stations = [station for station, _, _ in read_station_list(stationlist)]
+    idf = read_idf_tables(stations, idf_folder or savefolder)
+    if idf is None:
+        return None
+    durations = {label: hours for label, hours in NOAA_DURATIONS.items()
+                 if label in idf.index.get_level_values('duration')}
+
+    station_events, station_maxima = [], []
+    for station in idf.index.unique('station'):
+        if control is not None:
+            control.checkpoint()
+        report(f'IDF comparison: {station}')
+        a = read_station_data(station, savefolder, formats)
+        computed = cumulative_remove(a, inter_event_hours)
+        events = rain_events(a, inter_event_hours, computed)
+        station_events.append(events.assign(station=station))
+        station_maxima.append(event_depth_maxima(a, events, computed, durations))
+    events = pd.concat(station_events, ignore_index=True)
+    events = events[['station'] + [name for name in events.columns if name != 'station']]
+    maxima = np.concatenate(station_maxima)
+
+    periods = idf.columns.to_numpy(dtype=float)
+    years = np.empty_like(maxima)
+    for column, label in enumerate(durations):
+        idf_depths = idf.reindex(pd.MultiIndex.from_arrays([events['station'], [label] * len(events)])).to_numpy()
+        years[:, column] = return_periods(maxima[:, column], idf_depths, periods)
+
+    labels = list(durations)
+    ranked = np.nan_to_num(years, nan=-1.0)
+    critical = ranked.argmax(axis=1)
+    largest = ranked[np.arange(len(events)), critical]
+    events['return_period'] = np.where(largest < 0, np.nan, largest)
+    events['critical_duration'] = np.where(largest < 0, '', np.array(labels, dtype=object)[critical])
+    for column, label in enumerate(labels):
+        events[f'{label} depth'] = maxima[:, column]
+        events[f'{label} years'] = years[:, column]
+    events.to_csv(savefolder + '/' + listname + '_idf_comparison.csv', index=False)
+    report(f'IDF comparison: {len(events)} events of {len(station_events)} stations')
+    return events
 
 
 
@@ -0,0 +1,111 @@
+'''
+Command line entry point of AquaTrack, for scheduled batch jobs on machines without a display. It drives the same
+pipeline as the Tk window (AquaTrack.py):
+
+    python aquatrack_cli.py rain --stations RG_list.csv --template "CUMULATIVE REMOVE formula.xlsx" --out results
+    python aquatrack_cli.py idf --coordinates results/RG_list_coordinates.csv
+    python aquatrack_cli.py compare --stations RG_list.csv --out results
+
+rain downloads the rain data of a station list and writes the processed Excel files, rainfall events and interval
+totals, coordinates and kmz; idf downloads
+the NOAA IDF tables of a coordinate (or station) list; compare gives every rainfall event of the list the return period
+its gauge's IDF table puts on it. The exit status is 1 when a station failed, so cron can report it.
+'''
+import argparse
+import multiprocessing
+import os
+import sys
+
+from Aquatrack_functions import (run_station_list, download_idf, compare_idf, ProgressEvent, STORAGE_FORMATS, MAX_WORKERS,
+                                 EMPTY_TTL_DAYS, INTER_EVENT_HOURS)
+
+
+def print_progress(event):
+    # the pipeline prints every day already, only the step messages are added
+    if not isinstance(event, ProgressEvent):
+        print(f'[aquatrack] {event}', flush=True)
+
+
+def run_rain(args):
+    os.makedirs(args.out, exist_ok=True)
+    summary = run_station_list(args.stations, args.template, args.out, progress=print_progress,
+                               station_workers=args.station_workers, resume=not args.no_resume, update=args.update,
+                               formats=args.format, empty_ttl_days=args.empty_ttl_days, cache_folder=args.cache_dir,
+                               max_workers=args.day_workers, excel_mode=args.excel_mode,
+                               rain_summary=not args.no_events, inter_event_hours=args.inter_event_hours,
+                               range_days=args.range_days, min_interval=args.min_interval)
+    return 1 if (summary['status'] == 'failed').any() else 0
+
+
+def run_idf(args):
+    download_idf(args.coordinates, args.out, max_workers=args.day_workers, cache_folder=args.cache_dir,
+                 progress=print_progress)
+    return 0
+
+
+def run_compare(args):
+    compare_idf(args.stations, args.out, args.idf_dir, formats=args.format, inter_event_hours=args.inter_event_hours,
+                progress=print_progress)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='aquatrack', description='Headless AquaTrack: rain gauge and IDF downloads')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rain = commands.add_parser('rain', help='download the rain data of a station list')
+    rain.add_argument('--stations', required=True, help='csv listing station name, start date and end date per line')
+    rain.add_argument('--template', required=True, help='the CUMULATIVE REMOVE formula.xlsx template')
+    rain.add_argument('--out', required=True, help='folder the csv, xlsx, coordinate and kmz files are saved to')
+    rain.add_argument('--format', nargs='+', choices=STORAGE_FORMATS, default=['csv'],
+                      help='storage formats of the station data (default: csv)')
+    rain.add_argument('--excel-mode', choices=['formulas', 'values'], default='formulas',
+                      help='write the template formulas, or the values computed by AquaTrack (default: formulas)')
+    rain.add_argument('--station-workers', type=int, default=1, help='stations processed at the same time (default: 1)')
+    rain.add_argument('--update', action='store_true', help='bring existing station files up to today')
+    rain.add_argument('--no-resume', action='store_true', help='ignore the checkpoints of an earlier run of the list')
+    rain.add_argument('--empty-ttl-days', type=float, default=EMPTY_TTL_DAYS,
+                      help=f'days known-empty station-days are skipped (default: {EMPTY_TTL_DAYS})')
+    rain.add_argument('--range-days', type=int, default=1,
+                      help='days asked for per request, pages that cannot be split are fetched per day (default: 1)')
+    rain.add_argument('--min-interval', type=float, default=0.0,
+                      help='least seconds between two requests to wunderground, to stay under its rate limit '
+                           '(default: 0)')
+    rain.add_argument('--no-events', action='store_true',
+                      help='skip the rainfall event and 5-min/hourly/daily total files')
+    rain.add_argument('--inter-event-hours', type=float, default=INTER_EVENT_HOURS,
+                      help=f'hours without rain that separate two events (default: {INTER_EVENT_HOURS})')
+    rain.set_defaults(run=run_rain)
+
+    idf = commands.add_parser('idf', help='download the NOAA IDF tables of a coordinate or station list')
+    idf.add_argument('--coordinates', required=True, help='coordinate list (<list>_coordinates.csv) or station list')
+    idf.add_argument('--out', help='folder the <station>_idf.csv files are saved to (default: next to the list)')
+    idf.set_defaults(run=run_idf)
+
+    compare = commands.add_parser('compare', help='compare the rainfall events of a station list with their IDF tables')
+    compare.add_argument('--stations', required=True, help='csv listing station name, start date and end date per line')
+    compare.add_argument('--out', required=True, help='folder of the station data, the comparison is saved there too')
+    compare.add_argument('--idf-dir', help='folder of the <station>_idf.csv files (default: --out)')
+    compare.add_argument('--format', nargs='+', choices=STORAGE_FORMATS, default=['csv'],
+                         help='storage formats the station data was saved in (default: csv)')
+    compare.add_argument('--inter-event-hours', type=float, default=INTER_EVENT_HOURS,
+                         help=f'hours without rain that separate two events (default: {INTER_EVENT_HOURS})')
+    compare.set_defaults(run=run_compare)
+
+    for command in (rain, idf):
+        command.add_argument('--day-workers', type=int, default=MAX_WORKERS,
+                             help=f'downloads in flight at the same time (default: {MAX_WORKERS})')
+        command.add_argument('--cache-dir', help='folder of the page, IDF and station caches '
+                                                 '(default: <out>/aquatrack_cache)')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    # worker processes of the station scheduler import this module again
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,72 @@
+'''
+Times the dashboard page parser on saved html pages.
+
+Runs on the trimmed daily dashboard pages in fixtures/dashboard (a 5-minute station, a 10-minute station with missing
+cells, and a day without data):
+
+    python benchmark_parser.py [folder] [repeats]
+
+To time other pages, save them (https://www.wunderground.com/dashboard/pws/<STATION>/table/<date>/<date>/daily) into
+a folder as .html files and pass the folder.
+
+For every page it prints the time per parse of the old path (BeautifulSoup html.parser on the whole page, then CSS
+selects per row and cell) and of rain_cells/page_coordinates, and checks that both give the same rain cells and
+coordinates.
+'''
+import glob
+import os
+import sys
+import time
+
+from bs4 import BeautifulSoup
+from Aquatrack_functions import RAIN_COLUMNS, rain_cells, raw_table_from_soup, find_coordinates, page_coordinates
+
+# Saved pages the benchmark runs on when no folder is given
+FIXTURE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'dashboard')
+
+
+def time_per_call(function, content, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = function(content)
+    return (time.perf_counter() - start) / repeats, result
+
+
+def parse_with_soup(content):
+    soup = BeautifulSoup(content, 'html.parser')
+    df_data = raw_table_from_soup(soup)
+    if not set(RAIN_COLUMNS).issubset(df_data.columns):
+        return None, find_coordinates(soup)
+    return [df_data[name].tolist() for name in RAIN_COLUMNS], find_coordinates(soup)
+
+
+def parse_fast(content):
+    return rain_cells(content), page_coordinates(content)
+
+
+def main(folder=FIXTURE_FOLDER, repeats=5):
+    pages = sorted(glob.glob(os.path.join(folder, '*.html')))
+    if not pages:
+        print(f'No .html pages found in {folder}')
+        return
+
+    total_soup = total_fast = 0
+    print(f'{"page":40s} {"rows":>6s} {"soup ms":>10s} {"fast ms":>10s} {"speedup":>8s}')
+    for path in pages:
+        with open(path, 'rb') as page:
+            content = page.read()
+        soup_time, (soup_table, soup_coords) = time_per_call(parse_with_soup, content, repeats)
+        fast_time, (fast_table, fast_coords) = time_per_call(parse_fast, content, repeats)
+        if soup_table != fast_table or soup_coords != fast_coords:
+            print(f'{os.path.basename(path)}: the two parsers disagree')
+        total_soup += soup_time
+        total_fast += fast_time
+        print(f'{os.path.basename(path)[:40]:40s} {len(fast_table[0]) if fast_table else 0:6d} {soup_time * 1000:10.2f} {fast_time * 1000:10.2f} '
+              f'{soup_time / fast_time:7.1f}x')
+
+    print(f'{"mean per page":40s} {"":6s} {total_soup / len(pages) * 1000:10.2f} {total_fast / len(pages) * 1000:10.2f} '
+          f'{total_soup / total_fast:7.1f}x')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else FIXTURE_FOLDER, int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -0,0 +1,175 @@
+'''
+Checks the rain computations of Aquatrack_functions on small hand-made station tables whose answers are worked out
+below, so that a change to them shows up before it reaches a processed workbook:
+
+    python check_rain.py [template.xlsx]
+
+Given the CUMULATIVE REMOVE formula.xlsx template, it also writes a fixture station in both modes of fill_excel, has
+LibreOffice (soffice) compute the formulas workbook, and compares the D-L cells of every data row with those the values
+mode wrote.
+
+Every check prints ok or what differed, and the exit status is 1 when one of them failed.
+'''
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+from Aquatrack_functions import FORMULA_COLUMNS, HEADER_ROW, cumulative_remove, deaccumulate, event_depth_maxima, \
+    fill_excel, rain_events
+
+# LibreOffice, which computes the formulas of the workbooks fill_excel writes
+SOFFICE = shutil.which('soffice') or shutil.which('libreoffice')
+# Most cells of each column printed when the two modes of fill_excel disagree
+SHOWN_CELLS = 5
+
+
+# Function to build a station table from readings given as (time, paccum) pairs, None for a missing paccum
+def station_table(readings):
+    times, paccum = zip(*readings)
+    return pd.DataFrame({'datetime': pd.to_datetime(list(times)), 'prate': 0.0,
+                         'paccum': [np.nan if value is None else value for value in paccum]})
+
+
+# Function to compare a computed column with its expected values, printing the rows that differ
+def same(name, computed, expected):
+    computed, expected = np.asarray(computed), np.asarray(expected)
+    if computed.dtype.kind == 'f':
+        differ = ~np.isclose(computed, expected, atol=1e-9, equal_nan=True)
+    else:
+        differ = computed != expected
+    if differ.any():
+        rows = np.flatnonzero(differ)
+        print(f'  {name} differs at rows {rows.tolist()}: {computed[rows].tolist()} instead of {expected[rows].tolist()}')
+        return False
+    return True
+
+
+def check_deaccumulate():
+    '''
+    One day with a missing reading, a gauge reset to 0 and a glitch that dips below an earlier reading, then the first
+    reading of the next day. Read as the rain summary does, the glitch adds no rain and the recovery only what rises
+    above the earlier level; read as the template does (drops_reset), the glitch is a reset like any other fall.
+    '''
+    a = station_table([('2021-01-01 00:05', 0.0), ('2021-01-01 00:15', 0.1), ('2021-01-01 00:25', 0.2),
+                       ('2021-01-01 00:35', None), ('2021-01-01 00:45', 0.3), ('2021-01-01 00:55', 0.0),
+                       ('2021-01-01 01:05', 0.05), ('2021-01-01 01:15', 0.02), ('2021-01-01 01:25', 0.1),
+                       ('2021-01-02 00:05', 0.04)])
+    flags = ['day reset', '', '', 'missing', '', 'gauge reset', '', 'drop', '', 'day reset']
+    rain = deaccumulate(a)
+    ok = same('increment', rain['increment'], [0, 0.1, 0.1, 0, 0.1, 0, 0.05, 0, 0.05, 0.04])
+    ok &= same('reset', rain['reset'], [1, 0, 0, 0, 0, 1, 0, 0, 0, 1])
+    ok &= same('flag', rain['flag'], flags)
+    template = deaccumulate(a, drops_reset=True)
+    ok &= same('template increment', template['increment'], [0, 0.1, 0.1, 0, 0.1, 0, 0.05, 0.02, 0.08, 0.04])
+    ok &= same('template reset', template['reset'], [1, 0, 0, 0, 0, 1, 0, 1, 0, 1])
+    ok &= same('template flag', template['flag'], flags)
+    return ok
+
+
+def check_event_depth_maxima():
+    '''
+    Two events of one day of 5-minute readings, 8 hours apart: 1 in falling 0.05 in every 5 minutes from 02:00, then
+    0.1 in falling 0.02 in every 5 minutes from 12:00. The windows of the second event must not reach back into the
+    first, so none of its durations holds more than its own 0.1 in.
+    '''
+    times = pd.date_range('2021-01-01 00:00', '2021-01-01 23:55', freq='5min')
+    rate = np.zeros(len(times))
+    rate[(times >= '2021-01-01 02:00') & (times < '2021-01-01 03:40')] = 0.05
+    rate[(times >= '2021-01-01 12:00') & (times < '2021-01-01 12:25')] = 0.02
+    a = pd.DataFrame({'datetime': times, 'prate': rate * 12, 'paccum': np.cumsum(rate).round(3)})
+    computed = cumulative_remove(a)
+    events = rain_events(a, computed=computed)
+    ok = same('event depth', events['depth'], [1.0, 0.1])
+    durations = {'5-min': 5 / 60, '30-min': 0.5, '60-min': 1, '24-hr': 24}
+    maxima = event_depth_maxima(a, events, computed, durations)
+    ok &= same('first event maxima', maxima[0], [0.05, 0.3, 0.6, 1.0])
+    ok &= same('second event maxima', maxima[1], [0.02, 0.1, 0.1, 0.1])
+    return ok
+
+
+# Function to build three days of 5-minute readings: two storms more than a day apart, the first broken by a gauge
+# reset and a glitch, and missing readings in and between them
+def fixture_station():
+    times = pd.date_range('2021-01-01 00:00', '2021-01-03 23:55', freq='5min')
+    rate = np.zeros(len(times))
+    rate[(times >= '2021-01-01 03:00') & (times < '2021-01-01 09:00')] = 0.01
+    rate[(times >= '2021-01-02 18:00') & (times < '2021-01-02 20:00')] = 0.03
+    paccum = pd.Series(rate).groupby(times.date).cumsum().round(3).to_numpy()
+    # the gauge restarts from 0 at 05:00, and reads 0.1 in low at 06:30
+    restarted = (times >= '2021-01-01 05:00') & (times < '2021-01-02')
+    paccum[restarted] -= paccum[times == '2021-01-01 05:00'][0]
+    paccum[times == '2021-01-01 06:30'] -= 0.1
+    paccum[(times == '2021-01-01 07:00') | (times == '2021-01-03 12:00')] = np.nan
+    return pd.DataFrame({'datetime': times, 'prate': rate * 12, 'paccum': np.round(paccum, 3)})
+
+
+# Function to open a workbook in LibreOffice and save it again, which computes its formulas, in folder
+def recalculate(path, folder):
+    subprocess.run([SOFFICE, '--headless', '--calc', '--convert-to', 'xlsx', '--outdir', folder, path], check=True,
+                   capture_output=True)
+    return os.path.join(folder, os.path.basename(path))
+
+
+# Function to compare two cell values, a blank being the same as an empty text
+def same_cell(formulas_value, values_value):
+    if formulas_value in (None, '') or values_value in (None, ''):
+        return formulas_value in (None, '') and values_value in (None, '')
+    if isinstance(formulas_value, (int, float)) and isinstance(values_value, (int, float)):
+        return bool(np.isclose(formulas_value, values_value, atol=1e-6))
+    return formulas_value == values_value
+
+
+def check_values_mode(template):
+    '''
+    The values mode of fill_excel computes the template's D-L columns itself. The fixture station is written in both
+    modes, and every D-L cell of its data rows must be what the template's own formulas give in LibreOffice.
+    '''
+    if SOFFICE is None:
+        print('  LibreOffice (soffice) is needed to compute the formulas workbook')
+        return False
+    data = fixture_station()
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ('formulas', 'values'):
+            os.mkdir(os.path.join(folder, mode))
+            fill_excel('FIXTURE', template, os.path.join(folder, mode), data=data, mode=mode)
+        computed = recalculate(os.path.join(folder, 'formulas', 'FIXTURE_processed.xlsx'),
+                               os.path.join(folder, 'recalculated'))
+        formulas_ws = load_workbook(computed, data_only=True).active
+        values_ws = load_workbook(os.path.join(folder, 'values', 'FIXTURE_processed.xlsx')).active
+        ok = True
+        rows = range(HEADER_ROW + 1, HEADER_ROW + len(data) + 1)
+        for column in FORMULA_COLUMNS:
+            differ = [(row, formulas_ws[f'{column}{row}'].value, values_ws[f'{column}{row}'].value) for row in rows
+                      if not same_cell(formulas_ws[f'{column}{row}'].value, values_ws[f'{column}{row}'].value)]
+            if differ:
+                ok = False
+                print(f'  column {column} differs in {len(differ)} of {len(rows)} rows (cell, formulas, values):')
+                for row, formulas_value, values_value in differ[:SHOWN_CELLS]:
+                    print(f'    {column}{row}: {formulas_value!r} {values_value!r}')
+    return ok
+
+
+# The checks run by main, in order
+CHECKS = [check_deaccumulate, check_event_depth_maxima]
+
+
+def main(template=None):
+    checks = [(check, ()) for check in CHECKS]
+    if template is not None:
+        checks.append((check_values_mode, (template,)))
+    failed = 0
+    for check, arguments in checks:
+        ok = check(*arguments)
+        print(f'{check.__name__}: {"ok" if ok else "FAILED"}')
+        failed += not ok
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv[1:2]))
@@ -184,43 +184,15 @@ def fill_excel(stationName):
 #paccumchoice = input("Do you want precipitation accumulation in addition to precipitation rate? Yes/No: ")
 paccumchoice = "Yes"
 
-# Accessing a text file - www.101computing.net/mp3-playlist/
-stationlist = input("Enter exact csv filename of station list, E.g. stationlist.csv, : ")
-# stationlist = 'stationlist_paccum.csv'
-file = open(stationlist, "r")
-all_coordinate_dict = {}
-# Repeat for each station in the .csv file
-for line in file:
-    # Let's split the line into an array called "fields" using the "," as a separator:
-    fields = line.split(",")
-
-    # and let's extract the data:
-    stationName = fields[0]
-    startDate_str = fields[1]
-    endDate_str = fields[2]
-    
-    startDate = convert(startDate_str)
-    endDate = convert(endDate_str)
-    print("Get " + stationName + " from: " + startDate_str + " to: " + endDate_str)
-
-    # collect rain data and the rain gauge coordination
-    collect_all_days(stationName, startDate, endDate, paccumchoice)
-    coordinates = coordinate(stationName, startDate.strftime("%Y-%m-%d"))
-    all_coordinate_dict[stationName] = coordinates
-
-    df_coordinate_all = pd.DataFrame(all_coordinate_dict).T.rename(columns={1:'Latitude (Degree)', 0:'Longitude (Degree)'})
-    fill_excel(stationName)
-
-
-
-# It is good practice to close the file at the end to free up resources
-file.close()
-
-# save the coordination file
-df_coordinate_all.to_csv(f'Coordination for {stationlist}')
-
-# Making KML file
-kml_making(df_coordinate_all)
+if __name__ == '__main__':
+    # The functions above are the first version of the scraper, kept for reference: fetch_one_day no longer writes the
+    # station csv. The run itself goes through the Aquatrack_functions pipeline, as the GUI and aquatrack_cli.py do.
+    from Aquatrack_functions import run_station_list
+
+    # Accessing a text file - www.101computing.net/mp3-playlist/
+    stationlist = input("Enter exact csv filename of station list, E.g. stationlist.csv, : ")
+    # stationlist = 'stationlist_paccum.csv'
+    run_station_list(stationlist, 'CUMULATIVE REMOVE formula.xlsx', '.')
 
 
 